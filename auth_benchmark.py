@@ -0,0 +1,229 @@
+#benchmarks for the authentication of fastapibasic.py
+#"python auth_benchmark.py logins" is a load test: latency of other requests while many logins run
+#it compares, in this process, a login that runs bcrypt inline in async def
+#(what /real_token did before) with one that uses the process pool of passwords.py
+#"python auth_benchmark.py logins --url http://127.0.0.1:8000" runs the same storm against a running
+#"uvicorn fastapibasic:app" (logins on /real_token, other requests on /)
+#"python auth_benchmark.py tokens" measures the auth overhead per request with and without token_cache.py
+#"python auth_benchmark.py jwt" compares sign and verify ops/sec of the backends in jwt_backends.py
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from fastapi import FastAPI, Form, HTTPException
+from jose import jwt
+from pydantic import BaseModel
+
+from jwt_backends import TokenError, available_backends, get_backend
+from passwords import PasswordPoolBusy, password_pool, pwd_context
+from token_cache import VerifiedTokenCache
+
+#the hash of "secret" from fastapibasic.py
+HASHED_SECRET = "$2b$12$EixZaYVK1fsbw1ZfbX3OXePaWxn96p36WQoeG6Lruj3vjPGga31lW"
+
+app = FastAPI()
+
+@app.get("/")
+async def ping():
+    return {"message": "Hello World"}
+
+@app.post("/login/inline")
+async def login_inline(username: str = Form(), password: str = Form()):
+    if not pwd_context.verify(password, HASHED_SECRET):
+        raise HTTPException(status_code=401)
+    return {"ok": True}
+
+@app.post("/login/pool")
+async def login_pool(username: str = Form(), password: str = Form()):
+    try:
+        verified = await password_pool.verify(password, HASHED_SECRET)
+    except PasswordPoolBusy:
+        #like /real_token in fastapibasic.py, counted as an error by the storm
+        raise HTTPException(status_code=503, headers={"Retry-After": "1"})
+    if not verified:
+        raise HTTPException(status_code=401)
+    return {"ok": True}
+
+
+def percentiles(latencies: list[float]):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"count": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "count": len(ordered),
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+#one client sends a ping every interval seconds while logins clients send logins back to back
+#a ping is measured from the time it was due, not from when it was sent
+#so a ping that could not even be sent while the event loop was blocked counts the whole wait
+async def storm(client, login_path: str, logins: int, seconds: float, interval: float = 0.01):
+    ping_latencies = []
+    login_latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def pinger():
+        due = time.perf_counter()
+        while due < deadline:
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            await client.get("/")
+            ping_latencies.append(time.perf_counter() - due)
+            due += interval
+
+    async def login_client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = await client.post(login_path, data={"username": "johndoe", "password": "secret"})
+            if response.status_code != 200:
+                errors += 1
+            login_latencies.append(time.perf_counter() - start)
+            if response.status_code == 503:
+                #a rejected client waits before trying again, like Retry-After asks
+                await asyncio.sleep(0.1)
+
+    await asyncio.gather(pinger(), *(login_client() for _ in range(logins)))
+    return percentiles(ping_latencies), percentiles(login_latencies), errors
+
+
+def report(name: str, pings: dict, logins: dict, errors: int):
+    print(
+        f"{name:<22} ping p50 {pings['p50_ms']:>8.2f} ms  p99 {pings['p99_ms']:>8.2f} ms  max {pings['max_ms']:>8.2f} ms"
+        f"  | {logins['count']} logins, p50 {logins['p50_ms']:>8.1f} ms, errors {errors}"
+    )
+
+
+async def run_logins(args):
+    timeout = httpx.Timeout(60.0)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            report("idle", *await storm(client, "/real_token", 0, args.seconds))
+            report("login storm", *await storm(client, "/real_token", args.logins, args.seconds))
+        return
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=timeout) as client:
+        #start the worker processes before measuring
+        await client.post("/login/pool", data={"username": "johndoe", "password": "secret"})
+        report("idle", *await storm(client, "/login/pool", 0, args.seconds))
+        report("storm, bcrypt inline", *await storm(client, "/login/inline", args.logins, args.seconds))
+        report("storm, process pool", *await storm(client, "/login/pool", args.logins, args.seconds))
+    print(f"password pool: {password_pool.stats()}")
+
+
+#the token path of get_current_user_real, with the same key, algorithm and models as fastapibasic.py
+SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
+ALGORITHM = "HS256"
+
+class TokenData(BaseModel):
+    username: str | None = None
+
+class UserInDB(BaseModel):
+    username: str
+    email: str | None = None
+    full_name: str | None = None
+    disabled: bool | None = None
+    hashed_password: str
+
+fake_users_db = {
+    "johndoe": {
+        "username": "johndoe",
+        "full_name": "John Doe",
+        "email": "johndoe@example.com",
+        "hashed_password": HASHED_SECRET,
+        "disabled": False,
+    }
+}
+
+def resolve_uncached(token: str):
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    token_data = TokenData(username=payload.get("sub"))
+    return UserInDB(**fake_users_db[token_data.username]), payload
+
+def resolve_cached(cache: VerifiedTokenCache, token: str):
+    user = cache.get(token)
+    if user is not None:
+        return user
+    user, payload = resolve_uncached(token)
+    cache.put(token, user, payload["exp"])
+    return user
+
+#per-request cost of authenticating a bearer token
+#"distinct" tokens is the number of clients, each sends its token over and over
+def run_tokens(args):
+    expire = datetime.now(timezone.utc) + timedelta(minutes=30)
+    tokens = [
+        jwt.encode({"sub": "johndoe", "exp": expire, "client": n}, SECRET_KEY, algorithm=ALGORITHM)
+        for n in range(args.distinct)
+    ]
+    cache = VerifiedTokenCache(maxsize=args.cache_size, max_ttl=60)
+    cases = {
+        "decode every request": lambda token: resolve_uncached(token),
+        "verified token cache": lambda token: resolve_cached(cache, token),
+    }
+    for name, resolve in cases.items():
+        start = time.perf_counter()
+        for i in range(args.requests):
+            resolve(tokens[i % len(tokens)])
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22} {elapsed / args.requests * 1e6:>8.1f} us per request")
+    print(f"token cache: {cache.stats()}")
+
+
+#sign and verify ops/sec of every JWT backend, on the claims create_access_token makes
+#every backend also has to verify the tokens of the others (they are all standard HS256 tokens)
+def run_jwt(args):
+    backends = [get_backend(SECRET_KEY, ALGORITHM, name) for name in available_backends()]
+    claims = {"sub": "johndoe", "exp": int(time.time()) + 1800}
+    tokens = {backend.name: backend.encode(claims) for backend in backends}
+    for backend in backends:
+        for name, token in tokens.items():
+            if backend.decode(token)["sub"] != "johndoe":
+                raise SystemExit(f"{backend.name} decoded a token of {name} wrong")
+        try:
+            backend.decode(tokens[backend.name][:-2] + "xx")
+            raise SystemExit(f"{backend.name} accepted a token with a broken signature")
+        except TokenError:
+            pass
+    for backend in backends:
+        start = time.perf_counter()
+        for _ in range(args.operations):
+            backend.encode(claims)
+        sign = args.operations / (time.perf_counter() - start)
+        token = tokens[backend.name]
+        start = time.perf_counter()
+        for _ in range(args.operations):
+            backend.decode(token)
+        verify = args.operations / (time.perf_counter() - start)
+        print(f"{backend.name:<8} sign {sign:>10.0f} ops/s  verify {verify:>10.0f} ops/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="authentication benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    logins = commands.add_parser("logins", help="latency of other requests during a login storm")
+    logins.add_argument("--logins", type=int, default=20, help="concurrent login clients")
+    logins.add_argument("--seconds", type=float, default=5.0, help="length of each run")
+    logins.add_argument("--url", help="test a running server instead of the in-process apps")
+
+    tokens = commands.add_parser("tokens", help="auth overhead per request with and without the token cache")
+    tokens.add_argument("--requests", type=int, default=50_000)
+    tokens.add_argument("--distinct", type=int, default=100, help="distinct tokens (clients)")
+    tokens.add_argument("--cache-size", type=int, default=10_000)
+
+    jwt_parser = commands.add_parser("jwt", help="sign and verify ops/sec of the JWT backends")
+    jwt_parser.add_argument("--operations", type=int, default=20_000, help="signs and verifies per backend")
+
+    args = parser.parse_args()
+    if args.command == "logins":
+        asyncio.run(run_logins(args))
+    elif args.command == "tokens":
+        run_tokens(args)
+    else:
+        run_jwt(args)
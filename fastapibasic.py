@@ -1088,8 +1088,6 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
 #uses Json Web Tokens(JWT) to ready the token for encryption
 #install python-jose and passlib
 
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 #for token expiration time
 from datetime import datetime, timedelta, timezone
 
@@ -1113,7 +1111,8 @@ class TokenData(BaseModel):
     username: str | None = None
 
 #passlib instance for encryption
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+#it is created in passwords.py, which can also run it in a pool of processes (see authenticate_user_async)
+from passwords import PasswordPoolBusy, password_pool, pwd_context
 
 fake_users_db_real = {
     "johndoe": {
@@ -1143,6 +1142,22 @@ def authenticate_user(fake_db, username: str, password: str):
         return False
     return user
 
+#the same for async def routes
+#bcrypt takes about 250 ms, run inline it would block the event loop and every other request with it
+#password_pool runs it in another process while the event loop keeps serving
+async def authenticate_user_async(fake_db, username: str, password: str):
+    user = get_user(fake_db, username)
+    if not user:
+        return False
+    if not await password_pool.verify(password, user.hashed_password):
+        return False
+    return user
+
+#the backend that signs and verifies tokens, with its key prepared once
+#set JWT_BACKEND to pick another implementation, see jwt_backends.py
+from jwt_backends import TokenError, get_backend
+jwt_backend = get_backend(SECRET_KEY, ALGORITHM)
+
 #creates a token with expiration time
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -1151,13 +1166,21 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
     #adding expiration time to the token
-    to_encode.update({"exp": expire})
+    #as seconds since the epoch, the form the JWT standard uses (every backend can write an int)
+    to_encode.update({"exp": int(expire.timestamp())})
     #using jwt to encrypt the token
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt_backend.encode(to_encode)
     return encoded_jwt
 
+#verified tokens and their users are cached until the token expires, see token_cache.py
+from token_cache import token_cache
+
 #checking the user from the database
 async def get_current_user_real(token: Annotated[str, Depends(oauth2_scheme_real)]):
+    #a token seen before skips decoding, the signature check and the user lookup
+    cached_user = token_cache.get(token)
+    if cached_user is not None:
+        return cached_user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -1165,18 +1188,20 @@ async def get_current_user_real(token: Annotated[str, Depends(oauth2_scheme_real
     )
     try:
         #using jwt to decode the token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt_backend.decode(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
         #storing the token corresponding data
         token_data = TokenData(username=username)
-    except JWTError:
+    except TokenError:
         raise credentials_exception
     #checking and returning the user from the database
     user = get_user(fake_users_db_real, username=token_data.username)
     if user is None:
         raise credentials_exception
+    #only valid tokens are cached (decode already rejected expired ones)
+    token_cache.put(token, user, payload.get("exp"))
     return user
 
 #for raising current user error
@@ -1187,12 +1212,27 @@ async def get_current_active_user_real(
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+#a def dependency (or a class like OAuth2PasswordRequestForm) is run in the threadpool, a thread hop per request
+#nonblocking runs cheap ones inline on the event loop instead
+#"python inline_deps.py module:app" lists the threadpool dispatches of every route of an app
+from inline_deps import nonblocking
+
 #real working login path
+#Depends() would construct OAuth2PasswordRequestForm in the threadpool, it only stores the form fields
+#so nonblocking constructs it inline
 @app.post("/real_token")
 async def login_for_access_token(
-    form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends(nonblocking(OAuth2PasswordRequestForm))]
 ) -> Token:
-    user = authenticate_user(fake_users_db_real, form_data.username, form_data.password)
+    try:
+        user = await authenticate_user_async(fake_users_db_real, form_data.username, form_data.password)
+    except PasswordPoolBusy:
+        #too many logins already waiting for a worker
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins, try again",
+            headers={"Retry-After": "1"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1208,6 +1248,16 @@ async def login_for_access_token(
     )
     return Token(access_token=access_token, token_type="bearer")
 
+#calls, queue time and rejections of the password pool
+@app.get("/metrics/passwords")
+async def read_password_stats():
+    return password_pool.stats()
+
+#hit rate of the verified token cache
+@app.get("/metrics/tokens")
+async def read_token_cache_stats():
+    return token_cache.stats()
+
 #uses jwt and passlib to get the current user
 @app.get("/users/current_me/", response_model=User)
 async def read_users_me(
@@ -1235,6 +1285,9 @@ async def add_process_time_header(request: Request, call_next):
     response = await call_next(request)
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = str(process_time)
+    #Server-Timing is the standard header for the same number (in ms), browser devtools show it
+    #sql_app/timing.py splits it further into db, endpoint and validation/serialization time
+    response.headers["Server-Timing"] = f"total;dur={process_time * 1000:.2f}"
     return response
 
 #cross origin resource sharing -> when the backend is in different domain from the frontend
@@ -1262,6 +1315,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+#rate limiting -> token buckets per client, shared by all workers of the host, see rate_limit.py
+#a login is about 250 ms of bcrypt, so the login paths get small limits, per ip and per username
+#(per username also stops guessing one password from many ips)
+#every other path gets a general limit per ip
+#added last so it runs first, a rejected request costs no more than the 429 itself
+from rate_limit import RateLimit, RateLimiter, RateLimitMiddleware
+
+rate_limiter = RateLimiter(
+    routes={
+        "/token": [RateLimit.per_minute(10, burst=5)],
+        "/real_token": [
+            RateLimit.per_minute(20, burst=10),
+            RateLimit.per_minute(5, key="username"),
+        ],
+    },
+    default=[RateLimit(rate=20, burst=40)],
+)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
+#allowed and rejected requests of this worker
+@app.get("/metrics/ratelimit")
+async def read_rate_limit_stats():
+    return rate_limiter.stats()
+
 @app.get("/")
 async def main():
     return {"message": "Hello World"}
@@ -1286,6 +1363,9 @@ def write_log(message: str):
     with open("log.txt", mode="a") as log:
         log.write(message)
 
+#a def dependency runs in the threadpool, this one only adds a task, so it runs inline on the event loop
+#nonblocking is from inline_deps.py, imported above with the login
+@nonblocking
 def get_query(background_tasks: BackgroundTasks, q: Union[str, None] = None): #using background tasks as a dependency
     if q:
         message = f"found query: {q}\n"
@@ -1425,6 +1505,12 @@ def root():
     b = "b" + a
     return {"hello world": b}
 
+#with this many routes the OpenAPI schema is built ahead of time, see prebuilt_openapi.py
+#"python prebuilt_openapi.py fastapibasic:app", then OPENAPI_PREBUILT=require in production
+from prebuilt_openapi import use_prebuilt_openapi
+
+use_prebuilt_openapi(app, "fastapibasic")
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
@@ -0,0 +1,121 @@
+#dependencies that run on the event loop instead of the threadpool
+#FastAPI runs a "def" dependency (or a class used as one) with run_in_threadpool, to not block the event loop
+#that is a thread hop and a context switch per dependency per request, even for a function that only
+#builds a dict, and a "def" dependency with yield costs two (one to enter, one to exit)
+#@nonblocking marks one as cheap: it is wrapped in an async def, so FastAPI calls it inline
+#only use it for code that never waits on anything (no db, no files, no network, no sleeping)
+#a blocking call in a nonblocking dependency stops every request of the worker
+
+#"python inline_deps.py module:app" lists the threadpool dispatches of every route of an app
+#e.g. "python inline_deps.py big_app.main:app", or "cd sql_app && python ../inline_deps.py main:app"
+
+import argparse
+import functools
+import importlib
+import inspect
+import os
+import sys
+from collections import Counter
+
+from fastapi import routing
+
+
+def nonblocking(call):
+    if inspect.isgeneratorfunction(call) or inspect.iscoroutinefunction(call) or inspect.isasyncgenfunction(call):
+        raise TypeError(f"{call.__name__}: only plain functions and classes can be made nonblocking")
+
+    #functools.wraps sets __wrapped__, FastAPI reads the parameters of the original through it
+    @functools.wraps(call)
+    async def inline(*args, **kwargs):
+        return call(*args, **kwargs)
+
+    return inline
+
+
+#how FastAPI runs a callable (the same order of checks FastAPI makes)
+#returns the threadpool dispatches it costs per request
+def dispatches(call):
+    while isinstance(call, functools.partial):
+        call = call.func
+    candidates = (call, inspect.unwrap(call))
+    if any(inspect.isgeneratorfunction(candidate) for candidate in candidates):
+        return 2
+    if any(inspect.isasyncgenfunction(candidate) or inspect.iscoroutinefunction(candidate) for candidate in candidates):
+        return 0
+    if inspect.isclass(call) or inspect.isroutine(call):
+        return 1
+    #an instance with __call__, like the security schemes of fastapi.security
+    return dispatches(type(call).__call__)
+
+
+def name_of(call):
+    while isinstance(call, functools.partial):
+        call = call.func
+    if not inspect.isroutine(call) and not inspect.isclass(call):
+        call = type(call)
+    return getattr(call, "__qualname__", repr(call))
+
+
+#the dependencies of a route that go to the threadpool, depth first like FastAPI solves them
+#a dependency used twice in one request is solved once (unless use_cache=False)
+def route_dispatches(dependant, seen=None):
+    seen = set() if seen is None else seen
+    found = []
+    for sub in dependant.dependencies:
+        key = (sub.call, tuple(sub.own_oauth_scopes or ()))
+        if sub.use_cache and key in seen:
+            continue
+        seen.add(key)
+        found.extend(route_dispatches(sub, seen))
+        count = dispatches(sub.call)
+        if count:
+            found.append((name_of(sub.call), count))
+    return found
+
+
+#the routes of an app with the dependencies of the routers they were included with
+#newer FastAPI versions keep included routers as they are and list them with iter_route_contexts
+def api_routes(app):
+    if hasattr(routing, "iter_route_contexts"):
+        routes = routing.iter_route_contexts(app.routes)
+    else:
+        routes = app.routes
+    return [route for route in routes if getattr(route, "dependant", None) is not None]
+
+
+def report(app):
+    by_dependency = Counter()
+    routes_of = Counter()
+    total = 0
+    for route in api_routes(app):
+        found = route_dispatches(route.dependant)
+        endpoint = dispatches(route.endpoint)
+        methods = ",".join(sorted(route.methods))
+        hops = sum(count for _, count in found) + endpoint
+        total += hops
+        names = [f"{name} x{count}" if count > 1 else name for name, count in found]
+        if endpoint:
+            names.append(f"{name_of(route.endpoint)} (endpoint)")
+        print(f"{methods:<10} {route.path:<40} {hops} threadpool  {', '.join(names) or '-'}")
+        for name, count in found:
+            by_dependency[name] += count
+            routes_of[name] += 1
+    print()
+    if not by_dependency:
+        print("no dependency is dispatched to the threadpool")
+    for name, count in by_dependency.most_common():
+        print(f"{name:<40} {count} dispatches over {routes_of[name]} routes")
+    print(f"{total} threadpool dispatches for one request to every route")
+
+
+def load(target: str):
+    module_name, _, attribute = target.partition(":")
+    #like uvicorn, modules are found from the current directory
+    sys.path.insert(0, os.getcwd())
+    return getattr(importlib.import_module(module_name), attribute or "app")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="threadpool dispatches of the dependencies of an app")
+    parser.add_argument("app", help="module:attribute, like for uvicorn")
+    report(load(parser.parse_args().app))
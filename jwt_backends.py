@@ -0,0 +1,133 @@
+#backends that sign and verify the JWTs of fastapibasic.py
+#all of them make and accept the same standard tokens, so the backend can be switched without logging anyone out
+#each one prepares its key once when it is created, instead of on every encode/decode call
+#pick one with the JWT_BACKEND environment variable, compare them with "python auth_benchmark.py jwt"
+#"jose" -> python-jose, what the tutorial uses (default)
+#"hmac" -> HS256/HS384/HS512 with the standard library only, the fastest here
+#"pyjwt" -> PyJWT, when it is installed ("pip install pyjwt")
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from jose import JWTError, jwk
+from jose import jwt as jose_jwt
+
+JWT_BACKEND = os.environ.get("JWT_BACKEND", "jose")
+
+
+#raised by every backend for a token that is not valid (bad signature, expired, malformed)
+class TokenError(Exception):
+    pass
+
+
+class JoseBackend:
+    name = "jose"
+
+    def __init__(self, secret_key: str, algorithm: str):
+        self.algorithm = algorithm
+        #python-jose builds a key object from the secret on every call unless it is given one
+        self.key = jwk.construct(secret_key, algorithm)
+
+    def encode(self, claims: dict):
+        return jose_jwt.encode(claims, self.key, algorithm=self.algorithm)
+
+    def decode(self, token: str):
+        try:
+            return jose_jwt.decode(token, self.key, algorithms=[self.algorithm])
+        except JWTError as e:
+            raise TokenError(str(e)) from e
+
+
+def b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+def b64decode(data: bytes):
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+#the HMAC algorithms of JWT are small enough to do directly
+#the keyed HMAC object is made once and copied for each token, so the key is never processed again
+#and the encoded header is the same for every token, so it is made once as well
+class HMACBackend:
+    name = "hmac"
+    digests = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+
+    def __init__(self, secret_key: str, algorithm: str):
+        if algorithm not in self.digests:
+            raise ValueError(f"The hmac backend only supports {', '.join(self.digests)}")
+        self.algorithm = algorithm
+        self.mac = hmac.new(secret_key.encode(), digestmod=self.digests[algorithm])
+        header = json.dumps({"alg": algorithm, "typ": "JWT"}, separators=(",", ":")).encode()
+        self.header = b64encode(header)
+
+    def sign(self, signing_input: bytes):
+        mac = self.mac.copy()
+        mac.update(signing_input)
+        return mac.digest()
+
+    def encode(self, claims: dict):
+        payload = b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        signing_input = self.header + b"." + payload
+        return (signing_input + b"." + b64encode(self.sign(signing_input))).decode()
+
+    def decode(self, token: str):
+        try:
+            signing_input, _, signature = token.encode().rpartition(b".")
+            header, _, payload = signing_input.partition(b".")
+            if json.loads(b64decode(header)).get("alg") != self.algorithm:
+                raise TokenError("Wrong algorithm")
+            if not hmac.compare_digest(self.sign(signing_input), b64decode(signature)):
+                raise TokenError("Signature verification failed")
+            claims = json.loads(b64decode(payload))
+        except (ValueError, AttributeError, UnicodeError) as e:
+            raise TokenError("Malformed token") from e
+        if not isinstance(claims, dict):
+            raise TokenError("Malformed token")
+        exp = claims.get("exp")
+        if exp is not None and (not isinstance(exp, (int, float)) or exp <= time.time()):
+            raise TokenError("Signature has expired")
+        return claims
+
+
+class PyJWTBackend:
+    name = "pyjwt"
+
+    def __init__(self, secret_key: str, algorithm: str):
+        import jwt
+
+        self.jwt = jwt
+        self.algorithm = algorithm
+        #PyJWT prepares (and checks) a key through the algorithm object
+        self.key = jwt.get_algorithm_by_name(algorithm).prepare_key(secret_key)
+
+    def encode(self, claims: dict):
+        return self.jwt.encode(claims, self.key, algorithm=self.algorithm)
+
+    def decode(self, token: str):
+        try:
+            return self.jwt.decode(token, self.key, algorithms=[self.algorithm])
+        except self.jwt.InvalidTokenError as e:
+            raise TokenError(str(e)) from e
+
+
+BACKENDS = {backend.name: backend for backend in (JoseBackend, HMACBackend, PyJWTBackend)}
+
+#the backends that can be used here, PyJWT is optional
+def available_backends():
+    names = ["jose", "hmac"]
+    try:
+        import jwt  # noqa: F401
+
+        names.append("pyjwt")
+    except ImportError:
+        pass
+    return names
+
+def get_backend(secret_key: str, algorithm: str, name: str = JWT_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JWT backend: {name}, use one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](secret_key, algorithm)
@@ -6,4 +6,13 @@ app = FastAPI(docs_url="/documentation", redoc_url=None)
 
 @app.get("/items/")
 async def read_items():
-    return [{"name": "Foo"}]
\ No newline at end of file
+    return [{"name": "Foo"}]
+
+#the schema is built ahead of time with "python prebuilt_openapi.py metadata.docs:app" from the folder above
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from prebuilt_openapi import use_prebuilt_openapi
+
+use_prebuilt_openapi(app, "metadata.docs")
@@ -35,4 +35,13 @@ app = FastAPI(
 
 @app.get("/items/")
 async def read_items():
-    return [{"name": "Katana"}]
\ No newline at end of file
+    return [{"name": "Katana"}]
+
+#the schema is built ahead of time with "python prebuilt_openapi.py metadata.main:app" from the folder above
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from prebuilt_openapi import use_prebuilt_openapi
+
+use_prebuilt_openapi(app, "metadata.main")
@@ -27,4 +27,14 @@ async def get_users():
 
 @app.get("/items/", tags=["items"])
 async def get_items():
-    return [{"name": "wand"}, {"name": "flying broom"}]
\ No newline at end of file
+    return [{"name": "wand"}, {"name": "flying broom"}]
+
+#the schema is built ahead of time with "python prebuilt_openapi.py metadata.tags:app" from the folder above
+#each tag above is also served on its own, /openapi/users.json and /openapi/items.json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from prebuilt_openapi import use_prebuilt_openapi
+
+use_prebuilt_openapi(app, "metadata.tags")
@@ -5,4 +5,14 @@ app = FastAPI(openapi_url="/api/v1/openapi.json")
 
 @app.get("/items/")
 async def read_items():
-    return [{"name": "Foo"}]
\ No newline at end of file
+    return [{"name": "Foo"}]
+
+#the schema is built ahead of time with "python prebuilt_openapi.py metadata.urls:app" from the folder above
+#served at the openapi_url above, /api/v1/openapi.json
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from prebuilt_openapi import use_prebuilt_openapi
+
+use_prebuilt_openapi(app, "metadata.urls")
@@ -0,0 +1,126 @@
+#password hashing off the event loop
+#bcrypt is slow on purpose (cost 12 is about 250 ms of CPU per hash or verify)
+#called inline in an async def route it blocks the event loop, so every other request of the worker waits
+#here hashing and verifying run in a small pool of processes instead
+#processes and not threads: the CPU work then runs next to the event loop instead of competing with it for the GIL
+#used by the login route of fastapibasic.py, see auth_benchmark.py for a load test
+
+import asyncio
+import multiprocessing
+import os
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+
+#configure with environment variables
+#workers -> processes doing bcrypt at the same time, more than the CPU count does not help
+#max_queue -> logins allowed to wait for a worker, the rest get PasswordPoolBusy (turned into a 503)
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_MAX_QUEUE = int(os.environ.get("PASSWORD_MAX_QUEUE", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+#these run in the worker processes, so they are module-level functions (they are pickled by name)
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return pwd_context.hash(password)
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+class PasswordPool:
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        #one semaphore per event loop, an asyncio.Semaphore belongs to the loop it first waited on
+        self._semaphores = weakref.WeakKeyDictionary()
+        self.waiting = 0
+        self.calls = 0
+        self.rejected = 0
+        #recent queue times (seconds waited for a free worker), for the percentiles in stats()
+        self.queue_times = deque(maxlen=1000)
+        self.max_queue_time = 0.0
+        self.restarts = 0
+
+    #the processes are started on first use
+    #spawn instead of fork, forking a server that already runs threads can copy locks in a held state
+    def executor(self):
+        if self._executor is None:
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    #a worker that died (e.g. killed by the OOM killer) breaks the whole executor for good
+    #it is dropped so the next call starts new processes, calls that are still running on it fail as well
+    def discard(self, executor):
+        if self._executor is executor:
+            self._executor = None
+            self.restarts += 1
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.workers)
+        return self._semaphores[loop]
+
+    #at most workers calls run at once, the others wait here (not in the executor queue)
+    #so the time spent waiting can be measured and the wait can be bounded
+    async def run(self, function, *args):
+        semaphore = self.semaphore()
+        if semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise PasswordPoolBusy()
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            queue_time = time.perf_counter() - queued_at
+            self.calls += 1
+            self.queue_times.append(queue_time)
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            #hashing and verifying can simply run again, once, on new processes
+            #if those break as well it is reported like a full queue (a 503) instead of a 500
+            for _ in range(2):
+                executor = self.executor()
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+                except BrokenProcessPool:
+                    self.discard(executor)
+            raise PasswordPoolBusy()
+        finally:
+            semaphore.release()
+
+    async def verify(self, plain_password, hashed_password):
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    async def hash(self, password):
+        return await self.run(get_password_hash, password)
+
+    def stats(self):
+        ordered = sorted(self.queue_times)
+        return {
+            "workers": self.workers,
+            "calls": self.calls,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "queue_ms_p50": ordered[len(ordered) // 2] * 1000 if ordered else 0.0,
+            "queue_ms_p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000 if ordered else 0.0,
+            "queue_ms_max": self.max_queue_time * 1000,
+        }
+
+
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_MAX_QUEUE)
@@ -0,0 +1,238 @@
+#OpenAPI documents built ahead of time and served from disk
+#FastAPI builds the schema of an app on the first request to /openapi.json, in every worker
+#with hundreds of routes (fastapibasic.py) that first request is slow and the schema dict stays in memory
+#here a build step writes it to files instead, and the app serves those bytes as they are
+
+#build: "python prebuilt_openapi.py metadata.main:app metadata.tags:app fastapibasic:app"
+#writes openapi_build/<module>/ with openapi.json, openapi.json.gz, one file pair per tag and manifest.json
+#serve: use_prebuilt_openapi(app, "metadata.main") at the end of the app's module
+#run the apps from this directory ("uvicorn metadata.main:app") so both can import this module
+
+#OPENAPI_PREBUILT picks what happens when a worker starts
+#"auto" (default) -> serve the build when there is one for the current routes, otherwise FastAPI generates it
+#"require" -> for production, a missing or outdated build stops the worker from starting
+#"off" -> FastAPI generates it, as usual
+#the build notices changed app settings (title, description, tags, ...) and changed routes,
+#endpoints, parameters and models, but the last ones only by their names and types
+#a field changed inside a model is not noticed, build again on every deploy
+
+import argparse
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import re
+import sys
+import warnings
+
+from fastapi import routing
+from starlette.requests import Request
+from starlette.responses import Response
+
+OPENAPI_PREBUILT = os.environ.get("OPENAPI_PREBUILT", "auto")
+OPENAPI_BUILD_DIR = os.environ.get(
+    "OPENAPI_BUILD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "openapi_build")
+)
+
+
+def type_name(annotation):
+    if isinstance(annotation, type):
+        return f"{annotation.__module__}.{annotation.__qualname__}"
+    return repr(annotation)
+
+#what the schema of one route depends on: method, path, endpoint, response model
+#and every parameter and body field with its type (also those of its dependencies)
+def route_signature(route):
+    parts = [",".join(sorted(route.methods or ())), route.path]
+    endpoint = getattr(route, "endpoint", None)
+    if endpoint is not None:
+        parts.append(f"{endpoint.__module__}.{endpoint.__qualname__}")
+    parts.append(type_name(getattr(route, "response_model", None)))
+    dependant = getattr(route, "dependant", None)
+    if dependant is not None:
+        parts.extend(parameter_signatures(dependant))
+    return " ".join(parts)
+
+def parameter_signatures(dependant):
+    for kind in ("path_params", "query_params", "header_params", "cookie_params", "body_params"):
+        for field in getattr(dependant, kind):
+            yield f"{kind}:{field.name}:{type_name(field.field_info.annotation)}"
+    for sub in dependant.dependencies:
+        yield from parameter_signatures(sub)
+
+#the settings of the app that go into the document next to the routes
+APP_SCHEMA_FIELDS = (
+    "title", "summary", "description", "version", "openapi_version", "openapi_tags",
+    "servers", "terms_of_service", "contact", "license_info",
+)
+
+#stored with the build, so a worker can tell if the build is still for its routes and settings
+def route_fingerprint(app):
+    if hasattr(routing, "iter_route_contexts"):
+        routes = routing.iter_route_contexts(app.routes)
+    else:
+        routes = app.routes
+    lines = sorted(route_signature(route) for route in routes if getattr(route, "include_in_schema", False))
+    settings = {name: getattr(app, name, None) for name in APP_SCHEMA_FIELDS}
+    lines.append(json.dumps(settings, sort_keys=True, default=repr))
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+#the schemas a part of the document refers to, and the ones those refer to
+def referenced_schemas(node, schemas: dict, found: set):
+    if isinstance(node, dict):
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.startswith("#/components/schemas/"):
+            name = ref.rsplit("/", 1)[1]
+            if name not in found and name in schemas:
+                found.add(name)
+                referenced_schemas(schemas[name], schemas, found)
+        for value in node.values():
+            referenced_schemas(value, schemas, found)
+    elif isinstance(node, list):
+        for value in node:
+            referenced_schemas(value, schemas, found)
+    return found
+
+
+#the document with only the operations of one tag and the schemas they use
+def tag_document(schema: dict, tag: str):
+    paths = {}
+    for path, operations in schema.get("paths", {}).items():
+        tagged = {
+            method: operation
+            for method, operation in operations.items()
+            if isinstance(operation, dict) and tag in operation.get("tags", ())
+        }
+        if tagged:
+            paths[path] = tagged
+    document = {key: value for key, value in schema.items() if key not in ("paths", "components", "tags")}
+    document["paths"] = paths
+    document["tags"] = [entry for entry in schema.get("tags", ()) if entry.get("name") == tag]
+    components = dict(schema.get("components", {}))
+    if "schemas" in components:
+        used = referenced_schemas(paths, components["schemas"], set())
+        components["schemas"] = {name: value for name, value in components["schemas"].items() if name in used}
+    if components:
+        document["components"] = components
+    return document
+
+
+def tag_filename(tag: str):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", tag) + ".json"
+
+
+#writes the json and a gzip of it, the ETag is the digest of the json
+#mtime=0 so building the same schema again gives the same bytes
+def write_document(directory: str, filename: str, document: dict):
+    body = json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode()
+    with open(os.path.join(directory, filename), "wb") as file:
+        file.write(body)
+    with open(os.path.join(directory, filename + ".gz"), "wb") as file:
+        file.write(gzip.compress(body, compresslevel=9, mtime=0))
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def build(app, name: str, build_dir: str = OPENAPI_BUILD_DIR):
+    directory = os.path.join(build_dir, name)
+    os.makedirs(directory, exist_ok=True)
+    schema = app.openapi()
+    files = {"openapi.json": write_document(directory, "openapi.json", schema)}
+    tags = {entry["name"] for entry in schema.get("tags", ())}
+    for operations in schema.get("paths", {}).values():
+        for operation in operations.values():
+            if isinstance(operation, dict):
+                tags.update(operation.get("tags", ()))
+    tag_files = {}
+    for tag in sorted(tags):
+        filename = tag_filename(tag)
+        files[filename] = write_document(directory, filename, tag_document(schema, tag))
+        tag_files[tag] = filename
+    manifest = {"fingerprint": route_fingerprint(app), "etags": files, "tags": tag_files}
+    with open(os.path.join(directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return directory, manifest
+
+
+#the bytes of one built file, with gzip for clients that accept it and 304 for an unchanged ETag
+#gzip and plain are two representations, so they get two ETags
+class PrebuiltDocument:
+    def __init__(self, directory: str, filename: str, etag: str):
+        with open(os.path.join(directory, filename), "rb") as file:
+            self.body = file.read()
+        with open(os.path.join(directory, filename + ".gz"), "rb") as file:
+            self.gzip_body = file.read()
+        self.etag = f'"{etag}"'
+        self.gzip_etag = f'"{etag}-gz"'
+
+    async def endpoint(self, request: Request):
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body, etag = self.gzip_body, self.gzip_etag
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body, etag = self.body, self.etag
+        headers["ETag"] = etag
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in if_none_match or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+
+#replaces the generated /openapi.json of app with the build of name
+#each tag is also served on its own, /openapi.json -> /openapi/<tag>.json
+#a root_path is not added to "servers" like FastAPI does, set servers= on the app when it needs one
+def use_prebuilt_openapi(app, name: str, mode: str = OPENAPI_PREBUILT, build_dir: str = OPENAPI_BUILD_DIR):
+    if mode == "off" or not app.openapi_url:
+        return False
+    directory = os.path.join(build_dir, name)
+    manifest_path = os.path.join(directory, "manifest.json")
+    problem = None
+    if not os.path.exists(manifest_path):
+        problem = f"no OpenAPI build for {name}"
+    else:
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if manifest["fingerprint"] != route_fingerprint(app):
+            problem = f"the OpenAPI build of {name} is for other routes, models or settings"
+    if problem is not None:
+        if mode == "require":
+            raise RuntimeError(f"{problem}, run: python prebuilt_openapi.py <module>:app")
+        #no build at all is the usual case in development, an outdated one is worth a warning
+        if os.path.exists(manifest_path):
+            warnings.warn(f"{problem}, generating it in-process")
+        return False
+    document = PrebuiltDocument(directory, "openapi.json", manifest["etags"]["openapi.json"])
+    app.router.routes[:] = [route for route in app.router.routes if getattr(route, "path", None) != app.openapi_url]
+    app.add_route(app.openapi_url, document.endpoint, include_in_schema=False)
+    base = app.openapi_url.removesuffix(".json")
+    for tag, filename in manifest["tags"].items():
+        tagged = PrebuiltDocument(directory, filename, manifest["etags"][filename])
+        app.add_route(f"{base}/{filename}", tagged.endpoint, include_in_schema=False)
+    #anything that still calls app.openapi() gets the build instead of a new schema
+    schema = None
+
+    def prebuilt_openapi():
+        nonlocal schema
+        if schema is None:
+            schema = json.loads(document.body)
+        return schema
+
+    app.openapi = prebuilt_openapi
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the OpenAPI documents of apps ahead of time")
+    parser.add_argument("apps", nargs="+", help="module:attribute, like for uvicorn")
+    parser.add_argument("--out", default=OPENAPI_BUILD_DIR, help="build directory")
+    args = parser.parse_args()
+    sys.path.insert(0, os.getcwd())
+    #the build itself has to generate, whatever OPENAPI_PREBUILT is
+    os.environ["OPENAPI_PREBUILT"] = "off"
+    for target in args.apps:
+        module_name, _, attribute = target.partition(":")
+        app = getattr(importlib.import_module(module_name), attribute or "app")
+        directory, manifest = build(app, module_name, args.out)
+        print(f"{target} -> {directory} ({len(manifest['tags'])} tags)")
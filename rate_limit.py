@@ -0,0 +1,271 @@
+#token bucket rate limiting, shared by every worker process on the host
+#each login costs a worker about 250 ms of bcrypt, so nothing should be able to send thousands of them
+#a bucket holds up to burst tokens and refills at rate tokens per second, every request takes one
+#an empty bucket means 429 Too Many Requests with Retry-After, answered before the app runs at all
+
+#the buckets live in a file in /dev/shm (memory, not disk) that every worker maps into its memory
+#so "gunicorn fastapibasic:app --workers 4" still allows burst requests per client and not 4 * burst
+#the file is a fixed hash table of slots (key hash, tokens, last refill time) guarded by a file lock
+#a full table drops the bucket refilled longest ago, a refilled bucket is the same as no bucket
+#used by fastapibasic.py, the rules per route are set there
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs
+
+#configure with environment variables
+#the file is created by the first worker, the others map the same one
+#slots are fixed when the file is created, delete the file to change them
+RATE_LIMIT_FILE = os.environ.get(
+    "RATE_LIMIT_FILE",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "fastapibasic-ratelimit"),
+)
+RATE_LIMIT_SLOTS = int(os.environ.get("RATE_LIMIT_SLOTS", "65536"))
+
+HEADER = struct.Struct("<8sQ")
+MAGIC = b"TBUCKET1"
+#key hash, tokens, last refill time
+SLOT = struct.Struct("<Qdd")
+#slots looked at for one key before the oldest of them is reused
+PROBES = 8
+
+
+class SharedTokenBuckets:
+    def __init__(self, path: str = RATE_LIMIT_FILE, slots: int = RATE_LIMIT_SLOTS):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        #the file lock only keeps other processes out, threads of this process share it
+        self._lock = threading.Lock()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            if len(header) == HEADER.size and header[:8] == MAGIC:
+                #another worker created it, use its size
+                slots = HEADER.unpack(header)[1]
+            else:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, HEADER.size + slots * SLOT.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self.map = mmap.mmap(self.fd, HEADER.size + slots * SLOT.size)
+
+    #the first PROBES slots from the key's hash position, the key's own slot if it has one
+    #otherwise an empty one, otherwise the one refilled longest ago
+    def _slot(self, key_hash: int):
+        start = key_hash % self.slots
+        reuse = None
+        oldest = math.inf
+        for probe in range(PROBES):
+            offset = HEADER.size + (start + probe) % self.slots * SLOT.size
+            slot_hash, tokens, stamp = SLOT.unpack_from(self.map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, stamp
+            if slot_hash == 0:
+                return offset, None, None
+            if stamp < oldest:
+                reuse, oldest = offset, stamp
+        return reuse, None, None
+
+    #takes a token from the bucket of key
+    #returns 0.0 when it was allowed, otherwise the seconds until a token is there again
+    def take(self, key: str, rate: float, burst: float):
+        #0 marks an empty slot, so no key hashes to it
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") | 1
+        #monotonic time is the same clock in every process of the host (and never jumps back)
+        now = time.monotonic()
+        with self._lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                offset, tokens, stamp = self._slot(key_hash)
+                if tokens is None:
+                    tokens = burst
+                else:
+                    tokens = min(burst, tokens + max(0.0, now - stamp) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - tokens) / rate
+                SLOT.pack_into(self.map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.map[HEADER.size:] = bytes(len(self.map) - HEADER.size)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+#one limit: rate requests per second with bursts up to burst, counted per client ip or per username
+#"username" is the username field of a login form (urlencoded or multipart)
+#requests where none can be read (other content types, bodies over max_form_size, no field)
+#all share one bucket per limit, so leaving the field out or hiding it does not get around the limit
+class RateLimit:
+    def __init__(self, rate: float, burst: float, key: str = "ip"):
+        if key not in ("ip", "username"):
+            raise ValueError("key has to be 'ip' or 'username'")
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+
+    @classmethod
+    def per_minute(cls, requests: int, burst: int | None = None, key: str = "ip"):
+        return cls(requests / 60, burst if burst is not None else requests, key)
+
+
+#the limits per route and the shared buckets they are counted in
+#routes -> path: list of RateLimit, a path ending with "*" is a prefix, the longest match wins
+#default -> the limits of every other path, [] for none
+class RateLimiter:
+    def __init__(self, routes: dict[str, list[RateLimit]], default: list[RateLimit] = (), buckets: SharedTokenBuckets | None = None):
+        self.exact = {path: limits for path, limits in routes.items() if not path.endswith("*")}
+        self.prefixes = sorted(
+            ((path[:-1], limits) for path, limits in routes.items() if path.endswith("*")),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self.default = list(default)
+        self.buckets = buckets if buckets is not None else SharedTokenBuckets()
+        #counted per worker process
+        self.allowed = 0
+        self.rejected = 0
+
+    def limits_for(self, path: str):
+        if path in self.exact:
+            return path, self.exact[path]
+        for prefix, limits in self.prefixes:
+            if path.startswith(prefix):
+                return prefix + "*", limits
+        return "*", self.default
+
+    #all limits of the route have to allow the request, returns the seconds to wait or 0.0
+    def check(self, route: str, limits: list[RateLimit], ip: str, username: str | None):
+        wait = 0.0
+        #every limit has its own buckets, so a route can have e.g. a burst limit and a longer one
+        for number, limit in enumerate(limits):
+            if limit.key == "ip":
+                key = f"{route}|{number}|{ip}"
+            elif username is not None:
+                key = f"{route}|{number}|user|{username}"
+            else:
+                key = f"{route}|{number}|unknown user"
+            wait = max(wait, self.buckets.take(key, limit.rate, limit.burst))
+        if wait:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self):
+        return {"allowed": self.allowed, "rejected": self.rejected, "slots": self.buckets.slots, "file": self.buckets.path}
+
+
+#one field of a urlencoded or multipart form body, None for other content types
+#a field sent more than once gives its last value, the one Starlette's FormData
+#(and so OAuth2PasswordRequestForm) reads, so decoy values in front of it change nothing
+def form_field(content_type: bytes, body: bytes, name: str):
+    if content_type.startswith(b"application/x-www-form-urlencoded"):
+        values = parse_qs(body.decode("latin-1")).get(name)
+        return values[-1] if values else None
+    if content_type.startswith(b"multipart/form-data"):
+        boundary = re.search(rb'boundary="?([^";]+)"?', content_type)
+        if boundary is None:
+            return None
+        found = None
+        for part in body.split(b"--" + boundary.group(1))[1:]:
+            head, separator, value = part.partition(b"\r\n\r\n")
+            field = re.search(rb'content-disposition:[^\r\n]*;\s*name="([^"]*)"', head, re.IGNORECASE)
+            if separator and field and field.group(1) == name.encode():
+                found = value.removesuffix(b"\r\n").decode("utf-8", "replace")
+        return found
+    return None
+
+
+#pure ASGI middleware, a rejected request never reaches FastAPI (no routing, no validation, no body parsing)
+#behind a proxy run uvicorn with --forwarded-allow-ips so that the client ip is the real one
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter, max_form_size: int = 64 * 1024):
+        self.app = app
+        self.limiter = limiter
+        self.max_form_size = max_form_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route, limits = self.limiter.limits_for(scope["path"])
+        if not limits:
+            return await self.app(scope, receive, send)
+        username = None
+        if any(limit.key == "username" for limit in limits):
+            username, receive = await self.read_username(scope, receive)
+        client = scope.get("client")
+        wait = self.limiter.check(route, limits, client[0] if client else "unknown", username)
+        if wait:
+            return await self.reject(send, wait)
+        return await self.app(scope, receive, send)
+
+    #the username of a login form, urlencoded or multipart (OAuth2PasswordRequestForm reads both)
+    #the body is read here, also when it is chunked, so the app gets a receive that hands it over again
+    #a body over max_form_size is not a login form, reading stops there and the app gets the rest as usual
+    async def read_username(self, scope, receive):
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_form_size:
+            return None, receive
+        messages = []
+        size = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                #the client went away, let the app see it
+                return None, self.replay(messages, receive)
+            size += len(message.get("body", b""))
+            if size > self.max_form_size:
+                return None, self.replay(messages, receive)
+            if not message.get("more_body", False):
+                break
+        body = b"".join(message.get("body", b"") for message in messages)
+        username = form_field(headers.get(b"content-type", b""), body, "username")
+        return (username.strip().lower() if username else None), self.replay(messages, receive)
+
+    @staticmethod
+    def replay(messages, receive):
+        pending = list(messages)
+
+        async def replayed_receive():
+            if pending:
+                return pending.pop(0)
+            return await receive()
+
+        return replayed_receive
+
+    #a fixed small body, built without any response classes
+    @staticmethod
+    async def reject(send, wait: float):
+        body = b'{"detail":"Too many requests"}'
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                #whole seconds, rounded up so the client does not come back too early
+                (b"retry-after", str(math.ceil(wait)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,59 @@
+from sqlalchemy import insert
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models, schemas
+from crud import ITEMS_AFTER, ITEMS_PAGE, USER_BY_EMAIL, USER_BY_ID, USERS_AFTER, USERS_PAGE
+
+#async versions of the functions in crud.py
+#AsyncSession has no legacy query(), they run the same prebuilt select() statements as crud.py
+#items_loading cannot be "lazy" here since a lazy load would be implicit IO outside of await
+#writes use INSERT ... RETURNING like crud.py, so they need no refresh after commit
+
+async def get_user(db: AsyncSession, user_id: int, items_loading: str = "selectin"):
+    result = await db.scalars(USER_BY_ID[items_loading], {"user_id": user_id})
+    return result.unique().first()
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.scalars(USER_BY_EMAIL, {"email": email})
+    return result.first()
+
+
+async def get_users(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = None,
+    items_loading: str = "selectin",
+):
+    if after_id is not None:
+        result = await db.scalars(USERS_AFTER[items_loading], {"after_id": after_id, "limit": limit})
+    else:
+        result = await db.scalars(USERS_PAGE[items_loading], {"skip": skip, "limit": limit})
+    return result.unique().all()
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    fake_hashed_password = user.password + "notreallyhashed"
+    row = {"email": user.email, "hashed_password": fake_hashed_password}
+    db_user = (await db.scalars(insert(models.User).returning(models.User), [row])).one()
+    #a new user has no items, setting it here avoids a lazy load when the schema reads it
+    set_committed_value(db_user, "items", [])
+    await db.commit()
+    return db_user
+
+
+async def get_items(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    if after_id is not None:
+        result = await db.scalars(ITEMS_AFTER, {"after_id": after_id, "limit": limit})
+    else:
+        result = await db.scalars(ITEMS_PAGE, {"skip": skip, "limit": limit})
+    return result.all()
+
+
+async def create_user_item(db: AsyncSession, item: schemas.ItemCreate, user_id: int):
+    row = {**item.dict(), "owner_id": user_id}
+    stmt = insert(models.Item).returning(models.Item).execution_options(render_nulls=True)
+    db_item = (await db.scalars(stmt, [row])).one()
+    await db.commit()
+    return db_item
@@ -0,0 +1,28 @@
+#async version of database.py
+#the sync engine blocks a threadpool thread for every request (about 40 per worker)
+#the async engine waits on the event loop instead, so many more requests can be in flight
+#install the async SQLite driver with "pip install aiosqlite sqlalchemy[asyncio]"
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import timing
+from database import SQLALCHEMY_DATABASE_URL
+
+#same database file as the sync engine, only the driver changes
+ASYNC_SQLALCHEMY_DATABASE_URL = make_url(SQLALCHEMY_DATABASE_URL).set(drivername="sqlite+aiosqlite")
+
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+#events are registered on the sync engine inside the async one
+timing.instrument(async_engine.sync_engine)
+
+#expire_on_commit=False because an expired attribute would need a lazy load
+#and lazy loads (implicit IO) are not allowed in async code
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+#async dependency, the async counterpart of get_db in main.py
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
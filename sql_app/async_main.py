@@ -0,0 +1,88 @@
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import async_crud, models, schemas, timing
+from async_database import async_engine, get_async_db
+from dependencies import (
+    READ_USER_ITEMS_LOADING,
+    READ_USERS_ITEMS_LOADING,
+    next_cursor,
+    parse_cursor,
+)
+
+#the core routes of main.py as async def on the async engine
+#run it with "uvicorn async_main:app" or "SQL_APP_ASYNC=1 uvicorn main:app"
+#only the routes below are here: no bulk, export, search, stats or metrics routes,
+#no fields= and no ETag/304 handling, those are only served by the threaded app in main.py
+
+#create the tables through the async engine when the app starts
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with async_engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        await conn.run_sync(models.prepare_database)
+    yield
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+#Server-Timing header with db, endpoint and FastAPI time for every request, see timing.py
+app.router.route_class = timing.TimedRoute
+app.middleware("http")(timing.add_server_timing)
+
+@app.post("/users/", response_model=schemas.User)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user_by_email(db, email=user.email)
+    if db_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return await async_crud.create_user(db=db, user=user)
+
+@app.get("/users/", response_model=list[schemas.User] | schemas.UserPage)
+async def read_users(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    after_id = parse_cursor(after)
+    users = await async_crud.get_users(
+        db, skip=skip, limit=limit, after_id=after_id, items_loading=READ_USERS_ITEMS_LOADING
+    )
+    if after_id is None:
+        return users
+    return {"data": users, "next_cursor": next_cursor(users, limit)}
+
+@app.get("/users/{user_id}", response_model=schemas.User)
+async def read_user(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.get_user(db, user_id=user_id, items_loading=READ_USER_ITEMS_LOADING)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+@app.post("/users/{user_id}/items/", response_model=schemas.Item)
+async def create_item_for_user(
+    user_id: int, item: schemas.ItemCreate, db: AsyncSession = Depends(get_async_db)
+):
+    return await async_crud.create_user_item(db=db, item=item, user_id=user_id)
+
+@app.get("/items/", response_model=list[schemas.Item] | schemas.ItemPage)
+async def read_items(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    after_id = parse_cursor(after)
+    items = await async_crud.get_items(db, skip=skip, limit=limit, after_id=after_id)
+    if after_id is None:
+        return items
+    return {"data": items, "next_cursor": next_cursor(items, limit)}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app)
@@ -0,0 +1,530 @@
+#benchmarks for sql_app
+#run them from this folder, for example "python benchmark.py concurrency --clients 500"
+#every run uses its own temporary database so sql_app.db is never touched
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+#the database url has to be set before database.py is imported
+BENCH_DIR = tempfile.mkdtemp(prefix="sql_app_bench_")
+os.environ.setdefault("SQL_APP_DATABASE_URL", f"sqlite:///{BENCH_DIR}/bench.db")
+os.environ["SQL_APP_ASYNC"] = "0"
+
+import httpx
+
+import crud, models, schemas
+from database import SessionLocal, create_engines, create_sessionmakers
+
+#p50/p99 and throughput of a list of latencies in seconds
+def summarize(name: str, latencies: list[float], elapsed: float, errors: int = 0):
+    ordered = sorted(latencies)
+    p50 = ordered[len(ordered) // 2] if ordered else 0.0
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] if ordered else 0.0
+    result = {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": p50 * 1000,
+        "p99_ms": p99 * 1000,
+        "mean_ms": statistics.fmean(ordered) * 1000 if ordered else 0.0,
+    }
+    print(
+        f"{name:<28} {result['throughput']:>10.1f} req/s"
+        f"  p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  errors {errors}"
+    )
+    return result
+
+
+def seed_users(count: int, items_per_user: int = 2, session_local=SessionLocal):
+    db = session_local()
+    try:
+        for i in range(count):
+            user = crud.create_user(db, schemas.UserCreate(email=f"bench{i}@example.com", password="x"))
+            for j in range(items_per_user):
+                crud.create_user_item(db, schemas.ItemCreate(title=f"item {i}-{j}"), user_id=user.id)
+    finally:
+        db.close()
+
+#words for generated titles and descriptions, so text search has something to find
+#about 30k made-up words, so like real text most words are rare and a few are common
+SYLLABLES = "ka lo mi ne ru sa ti vo ze pa do fu gi ha ju".split()
+WORDS = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+WORDS += [word + "n" for word in WORDS] + [word + "s" for word in WORDS] + [word + "r" for word in WORDS]
+WORDS += [a + b + c + d for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES for d in SYLLABLES[:5]]
+
+#skewed choice of words, the first ones in WORDS are much more common than the rest
+def words(rng: random.Random, count: int):
+    return [WORDS[(int(rng.paretovariate(0.6)) - 1) % len(WORDS)] for _ in range(count)]
+
+#fills the tables much faster than the crud functions
+#plain executemany in large chunks inside one transaction, with the real schema and triggers
+def fast_seed(engine, users: int, items: int, chunk: int = 50_000, seed: int = 42):
+    rng = random.Random(seed)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        start_user = cursor.execute("SELECT coalesce(max(id), 0) FROM users").fetchone()[0]
+        for start in range(0, users, chunk):
+            rows = [
+                (start_user + i + 1, f"user{start_user + i + 1}@example.com", "seedhashed", 1)
+                for i in range(start, min(start + chunk, users))
+            ]
+            cursor.executemany(
+                "INSERT INTO users (id, email, hashed_password, is_active) VALUES (?, ?, ?, ?)", rows
+            )
+        total_users = start_user + users
+        for start in range(0, items, chunk):
+            rows = [
+                (
+                    " ".join(words(rng, 3)),
+                    " ".join(words(rng, 8)),
+                    rng.randint(1, total_users),
+                )
+                for _ in range(start, min(start + chunk, items))
+            ]
+            cursor.executemany("INSERT INTO items (title, description, owner_id) VALUES (?, ?, ?)", rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+#fires requests from many concurrent clients at an app in the same process
+#the app is called through ASGI so the numbers show the server side only (no sockets)
+#a request that takes longer than timeout seconds counts as an error
+async def run_clients(
+    app, name: str, clients: int, requests_per_client: int, paths: list[str], timeout: float = 10.0
+):
+    latencies = []
+    errors = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+
+        async def one_client(n: int):
+            nonlocal errors
+            for i in range(requests_per_client):
+                path = paths[(n + i) % len(paths)]
+                start = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(client.get(path), timeout)
+                    if response.status_code != 200:
+                        errors += 1
+                except (Exception, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_client(n) for n in range(clients)))
+        elapsed = time.perf_counter() - start
+    return summarize(name, latencies, elapsed, errors)
+
+#threaded (def routes) vs async (async def routes) under many concurrent clients
+def bench_concurrency(args):
+    import main
+    import async_main
+
+    seed_users(args.users)
+    paths = [f"/users/{i % args.users + 1}" for i in range(50)] + ["/users/?limit=20", "/items/?limit=20"]
+
+    async def run_all():
+        #the async app creates its tables in its lifespan, main.py already did it
+        #the async run goes first since timed out threaded requests keep their threads busy for a while
+        results = [
+            await run_clients(async_main.app, "async", args.clients, args.requests, paths, args.timeout),
+            await run_clients(main.app, "threaded", args.clients, args.requests, paths, args.timeout),
+        ]
+        await async_main.async_engine.dispose()
+        return results
+
+    return asyncio.run(run_all())
+
+
+#statements per request and latency of the write endpoints, one request at a time
+def bench_writes(args):
+    from sqlalchemy import event
+
+    import main
+    from database import engine
+
+    statements = [0]
+
+    def count(*_):
+        statements[0] += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+
+    async def run_all():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = []
+            for name in ("POST /users/", "POST /users/{user_id}/items/"):
+                latencies = []
+                statements[0] = 0
+                start = time.perf_counter()
+                for i in range(args.requests):
+                    request_start = time.perf_counter()
+                    if name == "POST /users/":
+                        await client.post("/users/", json={"email": f"writes{i}@example.com", "password": "x"})
+                    else:
+                        await client.post(f"/users/{i % 10 + 1}/items/", json={"title": f"write {i}"})
+                    latencies.append(time.perf_counter() - request_start)
+                result = summarize(name, latencies, time.perf_counter() - start)
+                result["statements_per_request"] = statements[0] / args.requests
+                print(f"{'':<28} {result['statements_per_request']:.1f} statements per request")
+                results.append(result)
+            return results
+
+    return asyncio.run(run_all())
+
+#FTS5 search (crud.search_items) vs a LIKE '%q%' scan on the same data
+def bench_search(args):
+    from sqlalchemy import and_, or_
+
+    import main
+    from database import engine
+
+    start = time.perf_counter()
+    fast_seed(engine, users=max(1, args.items // 100), items=args.items)
+    print(f"seeded {args.items} items in {time.perf_counter() - start:.1f} s")
+    #a few common words and some rare ones, like real search terms
+    queries = [WORDS[20], WORDS[50], f"{WORDS[1]} {WORDS[7]}", WORDS[900], WORDS[5000]]
+    results = []
+    db = SessionLocal()
+    try:
+        searches = {
+            "fts5": lambda q: crud.search_items(db, q=q, limit=args.limit),
+            "like": lambda q: db.query(models.Item)
+            .filter(and_(*[
+                or_(models.Item.title.like(f"%{word}%"), models.Item.description.like(f"%{word}%"))
+                for word in q.split()
+            ]))
+            .limit(args.limit)
+            .all(),
+        }
+        #per query, since a common word (many matches to rank) and a rare one behave very differently
+        for q in queries:
+            for name, search in searches.items():
+                latencies = []
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    query_start = time.perf_counter()
+                    search(q)
+                    latencies.append(time.perf_counter() - query_start)
+                results.append(summarize(f"{name} {q!r}", latencies, time.perf_counter() - start))
+    finally:
+        db.close()
+    return results
+
+#list endpoints through the ORM + response_model vs the fast=true path
+def bench_fastpath(args):
+    import main
+    from database import engine
+
+    fast_seed(engine, users=args.users, items=args.users * 5)
+    cases = [
+        ("GET /items/", f"/items/?limit={args.limit}"),
+        ("GET /users/", f"/users/?limit={args.limit // 5}"),
+    ]
+
+    async def run_all():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            results = []
+            for name, path in cases:
+                for mode, suffix in (("orm", ""), ("fast", "&fast=true")):
+                    latencies = []
+                    start = time.perf_counter()
+                    for i in range(args.requests):
+                        request_start = time.perf_counter()
+                        await client.get(f"{path}&skip={(i * args.limit) % args.users}{suffix}")
+                        latencies.append(time.perf_counter() - request_start)
+                    results.append(summarize(f"{name} {mode}", latencies, time.perf_counter() - start))
+            return results
+
+    return asyncio.run(run_all())
+
+#per-call Python overhead of the hot crud lookups
+#"query" builds a legacy Query on every call like crud.py used to, "prebuilt" runs the crud functions
+#that reuse module-level select() statements (see USER_BY_ID and friends in crud.py)
+#the tables are small and every lookup hits few rows, so the time is mostly SQLAlchemy, not SQLite
+def bench_statements(args):
+    from sqlalchemy.orm import selectinload
+
+    import main, timing
+
+    seed_users(args.users, items_per_user=2)
+    users = args.users
+
+    def user_query(db):
+        return db.query(models.User).options(selectinload(models.User.items))
+
+    cases = {
+        "get_user": (
+            lambda db, i: user_query(db).filter(models.User.id == i % users + 1).first(),
+            lambda db, i: crud.get_user(db, user_id=i % users + 1),
+        ),
+        "get_user_by_email": (
+            lambda db, i: db.query(models.User).filter(models.User.email == f"bench{i % users}@example.com").first(),
+            lambda db, i: crud.get_user_by_email(db, email=f"bench{i % users}@example.com"),
+        ),
+        "get_users": (
+            lambda db, i: user_query(db).offset(i % users).limit(10).all(),
+            lambda db, i: crud.get_users(db, skip=i % users, limit=10),
+        ),
+        "get_items": (
+            lambda db, i: db.query(models.Item).offset(i % users).limit(10).all(),
+            lambda db, i: crud.get_items(db, skip=i % users, limit=10),
+        ),
+    }
+    results = []
+    for name, variants in cases.items():
+        for mode, call in zip(("query", "prebuilt"), variants):
+            db = SessionLocal()
+            try:
+                for i in range(100):
+                    call(db, i)
+                latencies = []
+                start = time.perf_counter()
+                for i in range(args.calls):
+                    call_start = time.perf_counter()
+                    call(db, i)
+                    latencies.append(time.perf_counter() - call_start)
+                    #a fresh identity map every call, like a request
+                    db.expunge_all()
+                result = summarize(f"{name} {mode}", latencies, time.perf_counter() - start)
+                print(f"{'':<28} {result['mean_ms'] * 1000:.1f} us per call")
+                results.append(result)
+            finally:
+                db.close()
+    print(f"compiled statement cache: {timing.statement_cache_stats.stats()}")
+    return results
+
+#data-scale suite: the crud functions called directly (no HTTP) on tables of growing size
+#every scale gets its own database seeded with fast_seed, scale is the number of items
+#with one user per 10 items, the results can be saved as JSON and compared with an earlier run
+CRUD_SCALES = {"10k": 10_000, "1M": 1_000_000, "10M": 10_000_000}
+
+
+def crud_cases(users: int, rng: random.Random):
+    def random_user():
+        return rng.randint(1, users)
+
+    return {
+        "get_users": lambda db: crud.get_users(db, skip=rng.randint(0, max(users - 100, 0)), limit=100),
+        "get_users_cursor": lambda db: crud.get_users(
+            db, after_id=rng.randint(0, max(users - 100, 0)), limit=100
+        ),
+        "get_user": lambda db: crud.get_user(db, user_id=random_user()),
+        "get_user_by_email": lambda db: crud.get_user_by_email(db, email=f"user{random_user()}@example.com"),
+        "get_items": lambda db: crud.get_items(db, skip=rng.randint(0, users * 10 - 100), limit=100),
+        "get_items_cursor": lambda db: crud.get_items(
+            db, after_id=rng.randint(0, users * 10 - 100), limit=100
+        ),
+        "create_user_item": lambda db: crud.create_user_item(
+            db, schemas.ItemCreate(title="bench", description="crud suite"), user_id=random_user()
+        ),
+    }
+
+
+def run_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+    }
+
+
+def bench_crud(args):
+    results = []
+    for scale in args.scales:
+        items = CRUD_SCALES[scale]
+        users = max(items // 10, 100)
+        url = f"sqlite:///{BENCH_DIR}/crud_{scale}.db"
+        engine, read_engine = create_engines(url, "default")
+        models.Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            models.prepare_database(connection)
+        start = time.perf_counter()
+        fast_seed(engine, users=users, items=items)
+        print(f"[{scale}] seeded {users} users and {items} items in {time.perf_counter() - start:.1f} s")
+        session_local, _ = create_sessionmakers(engine, read_engine)
+        rng = random.Random(args.seed)
+        for name, call in crud_cases(users, rng).items():
+            latencies = []
+            db = session_local()
+            try:
+                start = time.perf_counter()
+                for _ in range(args.calls):
+                    call_start = time.perf_counter()
+                    call(db)
+                    latencies.append(time.perf_counter() - call_start)
+                    #a fresh identity map per call, like a new request
+                    db.expunge_all()
+                elapsed = time.perf_counter() - start
+            finally:
+                db.close()
+            result = summarize(f"[{scale}] {name}", latencies, elapsed)
+            result.update({"scale": scale, "function": name, "users": users, "items": items})
+            results.append(result)
+        engine.dispose()
+    report = {"info": run_info(), "calls": args.calls, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved {args.output}")
+    if args.compare:
+        compare_runs(args.compare, report, args.tolerance)
+    return report
+
+#prints the change in p50/p99 against an earlier JSON report
+#a p99 that got worse by more than tolerance (0.2 = 20%) is flagged as a regression
+def compare_runs(path: str, report: dict, tolerance: float):
+    with open(path) as f:
+        previous = json.load(f)
+    before = {(r["scale"], r["function"]): r for r in previous["results"]}
+    regressions = 0
+    print(f"compared with {path} ({previous['info'].get('commit')}, {previous['info']['timestamp']})")
+    for result in report["results"]:
+        old = before.get((result["scale"], result["function"]))
+        if old is None:
+            continue
+        change = (result["p99_ms"] - old["p99_ms"]) / old["p99_ms"] if old["p99_ms"] else 0.0
+        flag = "REGRESSION" if change > tolerance else ""
+        regressions += bool(flag)
+        print(
+            f"[{result['scale']}] {result['function']:<20} p50 {old['p50_ms']:.2f} -> {result['p50_ms']:.2f} ms"
+            f"  p99 {old['p99_ms']:.2f} -> {result['p99_ms']:.2f} ms ({change:+.0%}) {flag}"
+        )
+    print(f"{regressions} regressions")
+
+#mixed readers and writers on threads against the "default" and "wal" engine modes
+#each mode gets a fresh database file
+def bench_contention(args):
+    results = []
+    for mode in ("default", "wal"):
+        url = f"sqlite:///{BENCH_DIR}/contention_{mode}.db"
+        engine, read_engine = create_engines(url, mode)
+        models.Base.metadata.create_all(bind=engine)
+        session_local, read_session_local = create_sessionmakers(engine, read_engine)
+        seed_users(args.users, session_local=session_local)
+
+        latencies = {"read": [], "write": []}
+        errors = {"read": 0, "write": 0}
+        locked = [0]
+        stop = threading.Event()
+
+        def worker(kind: str, n: int):
+            session_factory = read_session_local if kind == "read" else session_local
+            i = 0
+            while not stop.is_set():
+                i += 1
+                start = time.perf_counter()
+                db = session_factory()
+                try:
+                    if kind == "read":
+                        crud.get_items(db, skip=(i * 37) % 100, limit=50)
+                        crud.get_user(db, user_id=(n + i) % args.users + 1)
+                    else:
+                        item = schemas.ItemCreate(title=f"contention {n}-{i}")
+                        crud.create_user_item(db, item, user_id=(n + i) % args.users + 1)
+                except Exception as e:
+                    errors[kind] += 1
+                    if "database is locked" in str(e):
+                        locked[0] += 1
+                finally:
+                    db.close()
+                latencies[kind].append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=worker, args=("read", n)) for n in range(args.readers)]
+        threads += [threading.Thread(target=worker, args=("write", n)) for n in range(args.writers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for kind in ("read", "write"):
+            results.append(summarize(f"{mode} {kind}", latencies[kind], elapsed, errors[kind]))
+        print(f"{mode}: {locked[0]} 'database is locked' errors")
+        engine.dispose()
+        read_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sql_app benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    concurrency = commands.add_parser("concurrency", help="threaded vs async routes")
+    concurrency.add_argument("--clients", type=int, default=500)
+    concurrency.add_argument("--requests", type=int, default=20, help="requests per client")
+    concurrency.add_argument("--users", type=int, default=200)
+    concurrency.add_argument("--timeout", type=float, default=10.0, help="seconds before a request fails")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    contention = commands.add_parser("contention", help="default vs wal engine mode under mixed load")
+    contention.add_argument("--readers", type=int, default=16)
+    contention.add_argument("--writers", type=int, default=8)
+    contention.add_argument("--seconds", type=float, default=10.0)
+    contention.add_argument("--users", type=int, default=100)
+    contention.set_defaults(func=bench_contention)
+
+    writes = commands.add_parser("writes", help="statements and latency of the create endpoints")
+    writes.add_argument("--requests", type=int, default=1000)
+    writes.set_defaults(func=bench_writes)
+
+    search = commands.add_parser("search", help="FTS5 search vs LIKE on many items")
+    search.add_argument("--items", type=int, default=1_000_000)
+    search.add_argument("--limit", type=int, default=20)
+    search.add_argument("--repeat", type=int, default=10, help="runs of each query")
+    search.set_defaults(func=bench_search)
+
+    fastpath = commands.add_parser("fastpath", help="ORM list endpoints vs the fast=true path")
+    fastpath.add_argument("--users", type=int, default=20_000)
+    fastpath.add_argument("--limit", type=int, default=1000, help="items per page (users get a fifth)")
+    fastpath.add_argument("--requests", type=int, default=100)
+    fastpath.set_defaults(func=bench_fastpath)
+
+    statements = commands.add_parser("statements", help="per-call overhead of legacy Query vs prebuilt statements")
+    statements.add_argument("--users", type=int, default=200)
+    statements.add_argument("--calls", type=int, default=5000, help="calls per function and variant")
+    statements.set_defaults(func=bench_statements)
+
+    crud_suite = commands.add_parser("crud", help="crud functions at growing table sizes, JSON results")
+    crud_suite.add_argument("--scales", nargs="+", choices=list(CRUD_SCALES), default=list(CRUD_SCALES))
+    crud_suite.add_argument("--calls", type=int, default=1000, help="calls per function and scale")
+    crud_suite.add_argument("--seed", type=int, default=1)
+    crud_suite.add_argument("--output", help="write the results to this JSON file")
+    crud_suite.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    crud_suite.add_argument("--tolerance", type=float, default=0.2, help="allowed p99 slowdown")
+    crud_suite.set_defaults(func=bench_crud)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
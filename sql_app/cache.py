@@ -0,0 +1,85 @@
+#a small in-process cache for hot crud lookups
+#entries are dropped when they are older than ttl seconds or when the cache is full (least recently used first)
+#the threadpool runs sync routes on many threads at once, so every access takes a lock
+#each worker process has its own cache, writes made by another worker are only seen after ttl
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+#configure with environment variables, a size of 0 turns the cache off
+USER_CACHE_SIZE = int(os.environ.get("SQL_APP_USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.environ.get("SQL_APP_USER_CACHE_TTL", "30"))
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        #bumped by every invalidation, see get_or_load
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            version = self._version
+        #the loader goes to the database, so it runs without holding the lock
+        value = loader()
+        with self._lock:
+            #if something was invalidated while loading, the loaded value may already be stale
+            #it is still returned to this caller but not stored
+            if version == self._version and self.maxsize > 0:
+                self._data[key] = (value, now + self.ttl)
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._version += 1
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+#user lookups by id (("id", user_id) -> schemas.User or None)
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
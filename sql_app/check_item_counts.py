@@ -0,0 +1,30 @@
+#consistency check for users.item_count
+#run it from this folder: "python check_item_counts.py" lists users whose counter is wrong
+#and "python check_item_counts.py --fix" recomputes every counter from the items table
+
+import argparse
+
+import crud
+from database import SessionLocal
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check (and fix) the per-user item counters")
+    parser.add_argument("--fix", action="store_true", help="recompute all counters")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        mismatches = crud.find_item_count_mismatches(db)
+        for user_id, stored, real in mismatches:
+            print(f"user {user_id}: item_count {stored}, real {real}")
+        print(f"{len(mismatches)} users with a wrong item_count")
+        if mismatches and args.fix:
+            crud.recompute_item_counts(db)
+            print(f"recomputed, {len(crud.find_item_count_mismatches(db))} wrong now")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
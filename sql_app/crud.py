@@ -1,38 +1,420 @@
-from sqlalchemy.orm import Session
+import base64
+import os
+import re
+
+from sqlalchemy import bindparam, func, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, lazyload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 import models, schemas
+from cache import user_cache
+from database import SessionLocal
+from group_commit import GroupCommitter
 
 #import the models and schemas to create, read, update, and delete data
 #these are CRUD operations
 #they take models and schemas as arguments and return models, schemas, or other python objects
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+#ways to load User.items together with the users
+#the default lazy relationship runs one extra query per user when the schema reads items (N+1)
+#"selectin" runs one more query for the whole page with WHERE owner_id IN (...)
+#"joined" loads everything in a single LEFT OUTER JOIN
+#"lazy" keeps the old per-user behavior
+ITEM_LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+    "lazy": lazyload,
+}
+
+
+#statements of the hottest lookups, built once when the module is imported
+#the values are bound parameters given at execution, so the same statement object is reused by every call
+#building a legacy Query per call and turning it into a select() costs more Python time than the
+#query itself on small lookups, and a prebuilt statement also keeps its SQL cache key (SQLAlchemy
+#memoizes it on the object), so a call goes straight to the compiled SQL in the engine's cache
+#hit rate of that cache: GET /metrics/statements (see timing.py)
+def user_select(items_loading: str = "selectin"):
+    return select(models.User).options(ITEM_LOADERS[items_loading](models.User.items))
+
+
+USER_BY_ID = {
+    loading: user_select(loading).where(models.User.id == bindparam("user_id")) for loading in ITEM_LOADERS
+}
+USER_BY_EMAIL = select(models.User).where(models.User.email == bindparam("email"))
+USER_ID_BY_EMAIL = select(models.User.id).where(models.User.email == bindparam("email"))
+#pages by offset (skip) and by keyset (after_id), see get_users
+USERS_PAGE = {
+    loading: user_select(loading).order_by(models.User.id).offset(bindparam("skip")).limit(bindparam("limit"))
+    for loading in ITEM_LOADERS
+}
+USERS_AFTER = {
+    loading: user_select(loading)
+    .where(models.User.id > bindparam("after_id"))
+    .order_by(models.User.id)
+    .limit(bindparam("limit"))
+    for loading in ITEM_LOADERS
+}
+ITEMS_PAGE = select(models.Item).order_by(models.Item.id).offset(bindparam("skip")).limit(bindparam("limit"))
+ITEMS_AFTER = (
+    select(models.Item)
+    .where(models.Item.id > bindparam("after_id"))
+    .order_by(models.Item.id)
+    .limit(bindparam("limit"))
+)
+
+#version and last change of a user, or of the items table as a whole, for conditional GETs
+USER_VERSION = select(models.User.version, models.User.updated_at).where(models.User.id == bindparam("user_id"))
+ITEMS_VERSION = select(models.TableVersion.version, models.TableVersion.updated_at).where(
+    models.TableVersion.name == "items"
+)
+
+#unique() is needed for "joined", which returns a row per item, and costs little for the others
+def get_user(db: Session, user_id: int, items_loading: str = "selectin"):
+    return db.scalars(USER_BY_ID[items_loading], {"user_id": user_id}).unique().first()
 
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return db.scalars(USER_BY_EMAIL, {"email": email}).first()
+
+
+def get_user_version(db: Session, user_id: int):
+    return db.execute(USER_VERSION, {"user_id": user_id}).first()
+
+
+def get_items_version(db: Session):
+    return db.execute(ITEMS_VERSION).first()
+
+
+#cursor pagination uses an opaque token that wraps the last primary key of a page
+#the client only sends it back, so the format can change without breaking anyone
+def encode_cursor(last_id: int):
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
 
+def decode_cursor(cursor: str):
+    #an empty cursor means "start from the first page"
+    if not cursor:
+        return 0
+    padded = cursor + "=" * (-len(cursor) % 4)
+    last_id = int(base64.urlsafe_b64decode(padded.encode()).decode())
+    #ids are 64-bit signed integers in SQLite, a bigger one fails with OverflowError when the query runs
+    if not 0 <= last_id < 2**63:
+        raise ValueError("cursor id out of range")
+    return last_id
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
 
+def get_users(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = None,
+    items_loading: str = "selectin",
+):
+    if after_id is not None:
+        #keyset pagination seeks on the primary key index instead of walking skipped rows
+        #so every page costs the same no matter how deep it is
+        params = {"after_id": after_id, "limit": limit}
+        return db.scalars(USERS_AFTER[items_loading], params).unique().all()
+    return db.scalars(USERS_PAGE[items_loading], {"skip": skip, "limit": limit}).unique().all()
+
+#item counts per user, read from the counter column
+#one page of users costs one indexed range of the users table, no matter how many items there are
+def get_user_item_counts(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    stmt = select(models.User.id, models.User.email, models.User.item_count)
+    stmt = stmt.order_by(models.User.id)
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    return db.execute(stmt.limit(limit)).all()
+
+#consistency check for the counters: users whose item_count differs from their real number of items
+#returns (user id, stored count, real count) rows
+def find_item_count_mismatches(db: Session):
+    real_count = func.count(models.Item.id)
+    stmt = (
+        select(models.User.id, models.User.item_count, real_count)
+        .outerjoin(models.Item, models.Item.owner_id == models.User.id)
+        .group_by(models.User.id)
+        .having(models.User.item_count != real_count)
+    )
+    return db.execute(stmt).all()
+
+#sets every counter from the items table again, the same UPDATE as models.RECOUNT_ITEMS
+RECOUNT_ITEMS = update(models.User).values(
+    item_count=select(func.count(models.Item.id)).where(models.Item.owner_id == models.User.id).scalar_subquery()
+)
+
+def recompute_item_counts(db: Session):
+    db.execute(RECOUNT_ITEMS)
+    db.commit()
+    user_cache.clear()
+
+
+#for exports, these go through the whole table with a server-side cursor
+#yield_per fetches and builds batch_size rows at a time, so memory does not grow with the table
+#(the session only keeps weak references to the objects that were already handed out)
+def iter_users(db: Session, is_active: bool | None = None, batch_size: int = 1000):
+    stmt = select(models.User).options(selectinload(models.User.items)).order_by(models.User.id)
+    if is_active is not None:
+        stmt = stmt.where(models.User.is_active == is_active)
+    return db.scalars(stmt.execution_options(yield_per=batch_size))
+
+
+#writes get the generated id and defaults back from INSERT ... RETURNING
+#and sessions do not expire objects on commit (see database.py)
+#so there is no refresh SELECT after the commit
 def create_user(db: Session, user: schemas.UserCreate):
     fake_hashed_password = user.password + "notreallyhashed"
-    db_user = models.User(email=user.email, hashed_password=fake_hashed_password)
-    db.add(db_user)
+    row = {"email": user.email, "hashed_password": fake_hashed_password}
+    db_user = insert_returning(db, models.User, [row])[0]
     db.commit()
-    db.refresh(db_user)
+    #the id could be cached as "no such user"
+    user_cache.invalidate(("id", db_user.id))
     return db_user
 
+#the duplicate check of POST /users/, one indexed lookup of the id and nothing loaded with it
+#not cached: a cached "not registered" goes stale as soon as another worker registers the email
+def email_registered(db: Session, email: str):
+    return db.scalars(USER_ID_BY_EMAIL, {"email": email}).first() is not None
+
+#cached version of get_user, see cache.py
+#it returns schemas.User snapshots instead of ORM objects
+#since ORM objects belong to the session of the request that loaded them
+#min_version is a version of the user just read from the database
+#a cached snapshot older than that (or a cached "no such user") was written by another process since it was cached
+def get_user_cached(db: Session, user_id: int, items_loading: str = "joined", min_version: int | None = None):
+    def load():
+        db_user = get_user(db, user_id, items_loading=items_loading)
+        if db_user is None:
+            return None
+        return schemas.User.model_validate(db_user, from_attributes=True)
+
+    user = user_cache.get_or_load(("id", user_id), load)
+    if min_version is not None and (user is None or user.version < min_version):
+        user_cache.invalidate(("id", user_id))
+        user = user_cache.get_or_load(("id", user_id), load)
+    return user
+
+
+def get_items(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    if after_id is not None:
+        return db.scalars(ITEMS_AFTER, {"after_id": after_id, "limit": limit}).all()
+    return db.scalars(ITEMS_PAGE, {"skip": skip, "limit": limit}).all()
+
 
-def get_items(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Item).offset(skip).limit(limit).all()
+def iter_items(db: Session, owner_id: int | None = None, batch_size: int = 1000):
+    stmt = select(models.Item).order_by(models.Item.id)
+    if owner_id is not None:
+        stmt = stmt.where(models.Item.owner_id == owner_id)
+    return db.scalars(stmt.execution_options(yield_per=batch_size))
+
+
+#fast read path for list endpoints
+#selects only the columns the response schema has, as plain rows instead of ORM objects
+#the endpoint turns them into JSON directly, without building schema objects again
+ITEM_COLUMNS = [getattr(models.Item, name) for name in schemas.Item.model_fields]
+USER_COLUMNS = [getattr(models.User, name) for name in schemas.User.model_fields if name != "items"]
+
+
+#sparse fieldsets (fields=... on the endpoints) select only the named columns
+#id is always kept, cursors and the items of a user page need it
+def pick_columns(columns: list, fields: list[str] | None):
+    if fields is None:
+        return columns
+    return [column for column in columns if column.key in fields or column.key == "id"]
+
+
+def get_items_rows(
+    db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None, fields: list[str] | None = None
+):
+    stmt = select(*pick_columns(ITEM_COLUMNS, fields))
+    #ordered by id for skip pages too, like the cursor pages
+    stmt = stmt.order_by(models.Item.id)
+    if after_id is not None:
+        stmt = stmt.where(models.Item.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    return [row._asdict() for row in db.execute(stmt.limit(limit))]
+
+#users come with their items, loaded for the whole page with one IN query
+#unless fields leaves items out, then the items table is not read at all
+def get_users_rows(
+    db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None, fields: list[str] | None = None
+):
+    stmt = select(*pick_columns(USER_COLUMNS, fields))
+    #ordered by id in both cases, without it SQLite may read a covering index for a sparse projection
+    #(e.g. ix_users_email for fields=email) and return the page in that index's order
+    stmt = stmt.order_by(models.User.id)
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    users = [row._asdict() for row in db.execute(stmt.limit(limit))]
+    return add_items(db, users, fields)
+
+
+def get_user_row(db: Session, user_id: int, fields: list[str] | None = None):
+    stmt = select(*pick_columns(USER_COLUMNS, fields)).where(models.User.id == user_id)
+    row = db.execute(stmt).first()
+    if row is None:
+        return None
+    return add_items(db, [row._asdict()], fields)[0]
+
+
+def add_items(db: Session, users: list[dict], fields: list[str] | None = None):
+    if fields is not None and "items" not in fields:
+        return users
+    by_id = {}
+    for user in users:
+        user["items"] = []
+        by_id[user["id"]] = user
+    if by_id:
+        items = select(*ITEM_COLUMNS).where(models.Item.owner_id.in_(by_id)).order_by(models.Item.id)
+        for item in db.execute(items):
+            by_id[item.owner_id]["items"].append(item._asdict())
+    return users
+
+
+#turns free text into an FTS5 query
+#each word becomes a quoted phrase so characters like * " - or AND/OR/NEAR are not read as FTS syntax
+#phrases separated by spaces all have to match
+def fts_query(q: str):
+    return " ".join(f'"{word}"' for word in re.findall(r"\w+", q))
+
+
+def search_items(db: Session, q: str, skip: int = 0, limit: int = 100):
+    match = fts_query(q)
+    if not match:
+        return []
+    #the page is picked inside the FTS table first, where FTS5 can sort by rank on its own
+    #then only those rows are joined with items
+    #rank is FTS5's bm25 score, lower is better
+    matches = (
+        select(models.items_fts.c.rowid, models.items_fts.c.rank)
+        .where(text("items_fts MATCH :match").bindparams(match=match))
+        .order_by(models.items_fts.c.rank)
+        .offset(skip)
+        .limit(limit)
+        .subquery()
+    )
+    stmt = (
+        select(models.Item)
+        .join(matches, matches.c.rowid == models.Item.id)
+        .order_by(matches.c.rank)
+    )
+    return db.scalars(stmt).all()
 
 
 def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
-    db_item = models.Item(**item.dict(), owner_id=user_id)
-    db.add(db_item)
+    if item_group_commit is not None:
+        #written and committed together with the items of other requests, see group_commit.py
+        db_item = item_group_commit.submit(item, user_id)
+    else:
+        db_item = write_user_item(db, item, user_id)
+        db.commit()
+    #the cached user lists its items
+    user_cache.invalidate(("id", user_id))
+    return db_item
+
+
+def write_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
+    return insert_returning(db, models.Item, [{**item.dict(), "owner_id": user_id}])[0]
+
+#optional group commit for create_user_item, turned on with SQL_APP_GROUP_COMMIT=1
+#a batch is committed after SQL_APP_GROUP_COMMIT_MS milliseconds or SQL_APP_GROUP_COMMIT_ROWS rows
+item_group_commit = None
+if os.environ.get("SQL_APP_GROUP_COMMIT", "0") == "1":
+    item_group_commit = GroupCommitter(
+        SessionLocal,
+        write_user_item,
+        max_delay_ms=float(os.environ.get("SQL_APP_GROUP_COMMIT_MS", "5")),
+        max_rows=int(os.environ.get("SQL_APP_GROUP_COMMIT_ROWS", "100")),
+    )
+
+
+#bulk versions of create_user and create_user_item for ingest jobs
+#all rows go in with one INSERT ... RETURNING (SQLAlchemy batches the VALUES) and one commit
+#instead of a commit and a refresh SELECT per row
+#rows that cannot be inserted are reported by their index in the batch and do not stop the others
+def create_users_bulk(db: Session, users: list[schemas.UserCreate]):
+    errors = []
+    rows = []
+    indexes = []
+    emails = [user.email for user in users]
+    existing = set()
+    for start in range(0, len(emails), 500):
+        chunk = emails[start:start + 500]
+        existing.update(db.scalars(select(models.User.email).where(models.User.email.in_(chunk))))
+    for index, user in enumerate(users):
+        if user.email in existing:
+            errors.append(schemas.BulkRowError(index=index, detail="Email already registered"))
+            continue
+        #the same email twice in one batch is a duplicate as well
+        existing.add(user.email)
+        rows.append({"email": user.email, "hashed_password": user.password + "notreallyhashed"})
+        indexes.append(index)
+    try:
+        created = insert_returning(db, models.User, rows)
+    except IntegrityError:
+        #someone else registered one of the emails after the check above
+        db.rollback()
+        created, row_errors = insert_one_by_one(db, models.User, rows, indexes, "Email already registered")
+        errors.extend(row_errors)
+    result = schemas.UserBulkResult(
+        created=[schemas.User.model_validate(user, from_attributes=True) for user in created],
+        errors=sorted_errors(errors),
+    )
+    db.commit()
+    user_cache.invalidate(*[("id", user.id) for user in result.created])
+    return result
+
+
+def create_user_items_bulk(db: Session, items: list[schemas.ItemCreate], user_id: int):
+    rows = [{**item.dict(), "owner_id": user_id} for item in items]
+    indexes = list(range(len(rows)))
+    errors = []
+    try:
+        created = insert_returning(db, models.Item, rows)
+    except IntegrityError:
+        db.rollback()
+        created, errors = insert_one_by_one(db, models.Item, rows, indexes, "Item could not be created")
+    result = schemas.ItemBulkResult(
+        created=[schemas.Item.model_validate(item, from_attributes=True) for item in created],
+        errors=sorted_errors(errors),
+    )
     db.commit()
-    db.refresh(db_item)
-    return db_item
\ No newline at end of file
+    user_cache.invalidate(("id", user_id))
+    return result
+
+
+def insert_returning(db: Session, model, rows: list[dict]):
+    if not rows:
+        return []
+    #without sort_by_parameter_order SQLAlchemy can send many rows per INSERT on SQLite
+    #the rows come back in no particular order so they are sorted by id
+    #render_nulls keeps None values in the statement so rows with and without a description share one INSERT
+    stmt = insert(model).returning(model).execution_options(render_nulls=True)
+    created = sorted(db.scalars(stmt, rows).all(), key=lambda row: row.id)
+    if model is models.User:
+        #new users have no items yet, this saves a lazy load per user when they are serialized
+        for user in created:
+            set_committed_value(user, "items", [])
+    return created
+
+#slow path after a failed batch, every row gets its own savepoint
+def insert_one_by_one(db: Session, model, rows: list[dict], indexes: list[int], detail: str):
+    created = []
+    errors = []
+    for index, row in zip(indexes, rows):
+        try:
+            with db.begin_nested():
+                created.extend(insert_returning(db, model, [row]))
+        except IntegrityError:
+            errors.append(schemas.BulkRowError(index=index, detail=detail))
+    return created, errors
+
+
+def sorted_errors(errors: list):
+    return sorted(errors, key=lambda error: error.index)
\ No newline at end of file
@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+from fastapi import HTTPException, Request
+
+import crud
+
+#shared by the routes in main.py and async_main.py
+
+#how each endpoint loads User.items, see crud.ITEM_LOADERS
+#a page of users reads every user's items so it loads them in one batch
+#a single user is one row so a join is the cheapest
+READ_USERS_ITEMS_LOADING = "selectin"
+READ_USER_ITEMS_LOADING = "joined"
+
+#turns the after query parameter into a primary key
+#a broken cursor is a client error, not a server error
+def parse_cursor(after: str | None):
+    if after is None:
+        return None
+    try:
+        return crud.decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+#sparse fieldsets: fields=id,email asks for only those fields of the response schema
+#returns the names (None for all fields), unknown names are a client error
+def parse_fields(fields: str | None, schema):
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if not names:
+        return None
+    unknown = [name for name in names if name not in schema.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+#the next cursor is only given when the page is full
+#rows are ORM objects, or dicts on the fast read path
+def next_cursor(rows: list, limit: int):
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return crud.encode_cursor(last["id"] if isinstance(last, dict) else last.id)
+
+
+#conditional GET
+#the ETag is built from a row version, so it changes with every write that changes the response
+#weak (W/) since the same data can be serialized in more than one way (e.g. fast=true)
+def make_etag(*parts):
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+#If-None-Match can list several ETags or be "*", they are compared without the W/ prefix
+def etag_matches(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+#ETag and Last-Modified headers, both for the 200 and the 304 response
+#updated_at is stored in UTC by SQLite's CURRENT_TIMESTAMP
+def validator_headers(etag: str, updated_at: datetime | None):
+    headers = {"ETag": etag}
+    if updated_at is not None:
+        headers["Last-Modified"] = format_datetime(updated_at.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
\ No newline at end of file
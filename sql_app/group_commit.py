@@ -0,0 +1,122 @@
+#group commit: writes from concurrent requests share one transaction
+#every commit waits for SQLite to fsync, so with one commit per request the fsync rate is the limit
+#here the first waiting write starts a batch, the batch is committed after max_delay_ms or max_rows
+#and every caller waits until that commit is done, so a returned row is as durable as before
+#the batches are written by one background thread
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class GroupCommitter:
+    def __init__(
+        self, session_factory, write_one, max_delay_ms: float = 5.0, max_rows: int = 100, timeout: float = 30.0
+    ):
+        #write_one(db, *args) adds one row in the session and returns it, without committing
+        self.session_factory = session_factory
+        self.write_one = write_one
+        self.max_delay = max_delay_ms / 1000
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+
+    #blocks until the batch of this write is committed
+    #returns the written row or raises the error of this row
+    #a write still queued after timeout seconds is taken back and raises TimeoutError, it is never written
+    #one that is already in a batch waits for the batch, its commit decides what was written
+    def submit(self, *args):
+        self._start()
+        future = Future()
+        self._queue.put((args, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "rows_per_batch": self.rows / self.batches if self.batches else 0.0,
+        }
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._flush(batch)
+            except Exception as error:
+                #e.g. the rollback after a failed commit failed as well
+                #the thread has to keep running, otherwise every later write waits for it forever
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    #the next batch: the first waiting write and what comes in until max_delay or max_rows
+    #writes whose caller gave up (see submit) are left out
+    def _collect(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.max_rows:
+            if deadline is None:
+                item = self._queue.get()
+            else:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_delay
+        return batch
+
+    def _flush(self, batch: list):
+        db = self.session_factory()
+        try:
+            try:
+                results = [self.write_one(db, *args) for args, _ in batch]
+            except SQLAlchemyError:
+                #one bad row should not fail the others
+                #write them again one by one, each in its own savepoint
+                db.rollback()
+                results = []
+                for args, _ in batch:
+                    try:
+                        with db.begin_nested():
+                            results.append(self.write_one(db, *args))
+                    except SQLAlchemyError as error:
+                        results.append(error)
+            db.commit()
+        except Exception as error:
+            #the commit failed, nothing of this batch was written
+            db.rollback()
+            results = [error] * len(batch)
+        finally:
+            db.close()
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -1,23 +1,65 @@
-from fastapi import Depends, FastAPI, HTTPException
+import json
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
                 
-import crud, models, schemas
-from database import SessionLocal, engine
+import crud, models, schemas, timing
+from cache import user_cache
+from database import (
+    USE_ASYNC_DB,
+    LazySession,
+    ReadSessionLocal,
+    SessionLocal,
+    engine,
+    pool_stats,
+    release_read_session,
+)
+from sharding import SHARDS
+from dependencies import (
+    READ_USER_ITEMS_LOADING,
+    READ_USERS_ITEMS_LOADING,
+    etag_matches,
+    make_etag,
+    next_cursor,
+    parse_cursor,
+    parse_fields,
+    validator_headers,
+)
 
 #import already imported Base from models
 #connect it with the engine from database
 #one can also use Alembic to start the database and migrations like in djangobasic  
 models.Base.metadata.create_all(bind=engine)
+with engine.begin() as connection:
+    models.prepare_database(connection)
 
 app = FastAPI()
+#Server-Timing header with db, endpoint and FastAPI time for every request, see timing.py
+#and read sessions released as soon as the handler returns, see release_read_session
+class SessionRoute(timing.TimedRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, release_read_session(endpoint), **kwargs)
+
+app.router.route_class = SessionRoute
+app.middleware("http")(timing.add_server_timing)
 
 #dependency
-def get_db():
-    db = SessionLocal()
+#GET requests only read, so they get a session on the read-only pool
+#(in the default engine mode both are the same, see database.py)
+#the session is only created on first use, see LazySession
+#one sync generator is two threadpool dispatches per request (enter and exit)
+#the read connection goes back to the pool in the handler's own dispatch, see SessionRoute above
+def get_db(request: Request):
+    if request.method in ("GET", "HEAD"):
+        db = LazySession(ReadSessionLocal, read_only=True)
+    else:
+        db = LazySession(SessionLocal)
     try:
         yield db
     finally:
@@ -25,26 +67,130 @@ def get_db():
 
 #use the crud functions to create a new user
 @app.post("/users/", response_model=schemas.User)
-#for SQLAlchemy, asynchronous functions cannot be used since most SQL's are synchronous
-#to use asynchronous databases and connect them with FastAPI, use other databases and ORMs
+#these routes are sync since the default SQLAlchemy engine is synchronous
+#FastAPI runs each of them in its threadpool
+#async_main.py has the core routes as async def on an async engine (SQL_APP_ASYNC=1, see database.py)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+    if crud.email_registered(db, email=user.email):
+        raise HTTPException(status_code=400, detail="Email already registered")
+    try:
+        return crud.create_user(db=db, user=user)
+    except IntegrityError:
+        #registered by another request between the check and the insert
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+
+#bulk version of create_user for ingest jobs
+#the whole list is inserted in one transaction
+#duplicate emails are reported in errors and the other rows are still created
+@app.post("/users/bulk", response_model=schemas.UserBulkResult)
+def create_users_bulk(
+    users: list[schemas.UserCreate], db: Session = Depends(get_db)
+):
+    return crud.create_users_bulk(db=db, users=users)
+
+#fast=true answers from plain rows with only the columns of the schema
+#the rows already have the shape of the schema, so they are written as JSON directly
+#and response_model validation is skipped (FastAPI does not validate a Response)
+#fields=... (sparse fieldsets) goes through the same path, with only the named columns selected
+#(id is always included) and a user's items only read when items is one of them
+FIELDS_QUERY = Query(None, description="comma separated fields to return, e.g. id,email")
+def json_rows(rows: list[dict], after_id: int | None, limit: int):
+    if after_id is None:
+        content = rows
+    else:
+        content = {"data": rows, "next_cursor": next_cursor(rows, limit)}
+    return Response(content=json.dumps(content), media_type="application/json")
 
 #use the crud functions to get all users
-@app.get("/users/", response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+#skip/limit still works for old clients
+#passing after (empty for the first page) switches to cursor pagination
+#then the response is a page with next_cursor to send back as after
+@app.get("/users/", response_model=list[schemas.User] | schemas.UserPage)
+def read_users(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    fast: bool = False,
+    fields: str | None = FIELDS_QUERY,
+    db: Session = Depends(get_db),
+):
+    after_id = parse_cursor(after)
+    field_names = parse_fields(fields, schemas.User)
+    if fast or field_names is not None:
+        rows = crud.get_users_rows(db, skip=skip, limit=limit, after_id=after_id, fields=field_names)
+        return json_rows(rows, after_id, limit)
+    users = crud.get_users(
+        db, skip=skip, limit=limit, after_id=after_id, items_loading=READ_USERS_ITEMS_LOADING
+    )
+    if after_id is None:
+        return users
+    return {"data": users, "next_cursor": next_cursor(users, limit)}
+
+#exports stream newline-delimited JSON (one object per line) instead of one big array
+#rows are validated and written as they come from the cursor, only one yield_per batch is held at a time
+#StreamingResponse runs a sync generator in the threadpool, one thread hop per next()
+#so the generator yields one chunk per batch (partitions() gives the yield_per batches), not one per row
+#the generator opens its own session, since the response keeps streaming after the handler returned
+def stream_ndjson(rows_from, schema):
+    db = ReadSessionLocal()
+    try:
+        for rows in rows_from(db).partitions():
+            yield "".join(schema.model_validate(row, from_attributes=True).model_dump_json() + "\n" for row in rows)
+    finally:
+        db.close()
+
+#item counts per user, a page costs the same however many items the users have
+#it has to be declared before /users/{user_id}, otherwise "stats" would be read as a user id
+@app.get("/users/stats", response_model=list[schemas.UserItemCount] | schemas.UserItemCountPage)
+def read_user_stats(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    db: Session = Depends(get_db),
+):
+    after_id = parse_cursor(after)
+    rows = crud.get_user_item_counts(db, skip=skip, limit=limit, after_id=after_id)
+    if after_id is None:
+        return rows
+    return {"data": rows, "next_cursor": next_cursor(rows, limit)}
+
+@app.get("/users/export")
+def export_users(is_active: bool | None = None):
+    rows = lambda db: crud.iter_users(db, is_active=is_active)
+    return StreamingResponse(stream_ndjson(rows, schemas.User), media_type="application/x-ndjson")
 
 #use the crud functions to get a user by id
+#polling clients send the ETag back in If-None-Match, when the version is the same
+#the answer is an empty 304 after a single primary key lookup of two columns
 @app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+def read_user(
+    user_id: int,
+    request: Request,
+    response: Response,
+    fields: str | None = FIELDS_QUERY,
+    db: Session = Depends(get_db),
+):
+    field_names = parse_fields(fields, schemas.User)
+    current = crud.get_user_version(db, user_id=user_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    headers = validator_headers(make_etag("user", user_id, current.version), current.updated_at)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if field_names is not None:
+        #not cached, the cache holds whole users
+        #if the user changed after the version check the ETag is older than the data, which is safe
+        row = crud.get_user_row(db, user_id=user_id, fields=field_names)
+        if row is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return Response(content=json.dumps(row), media_type="application/json", headers=headers)
+    db_user = crud.get_user_cached(
+        db, user_id=user_id, items_loading=READ_USER_ITEMS_LOADING, min_version=current.version
+    )
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    #the ETag comes from the version of the data that is sent, which may be newer than current
+    response.headers.update(validator_headers(make_etag("user", user_id, db_user.version), current.updated_at))
     return db_user
 
 #use the crud functions to create an item for a user
@@ -54,11 +200,94 @@ def create_item_for_user(
 ):
     return crud.create_user_item(db=db, item=item, user_id=user_id)
 
+#bulk version of create_item_for_user
+@app.post("/users/{user_id}/items/bulk", response_model=schemas.ItemBulkResult)
+def create_items_for_user_bulk(
+    user_id: int, items: list[schemas.ItemCreate], db: Session = Depends(get_db)
+):
+    return crud.create_user_items_bulk(db=db, items=items, user_id=user_id)
+
 #use the crud functions to get all items
-@app.get("/items/", response_model=list[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    items = crud.get_items(db, skip=skip, limit=limit)
-    return items
+@app.get("/items/", response_model=list[schemas.Item] | schemas.ItemPage)
+def read_items(
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    fast: bool = False,
+    fields: str | None = FIELDS_QUERY,
+    db: Session = Depends(get_db),
+):
+    after_id = parse_cursor(after)
+    field_names = parse_fields(fields, schemas.Item)
+    #one version for the whole items table, every page changes its ETag on any item write
+    #it is read before the page, so a write in between can only make the ETag older than the data
+    #and the next poll gets a 200 instead of a wrong 304
+    current = crud.get_items_version(db)
+    headers = validator_headers(make_etag("items", current.version), current.updated_at)
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if fast or field_names is not None:
+        rows = crud.get_items_rows(db, skip=skip, limit=limit, after_id=after_id, fields=field_names)
+        fast_response = json_rows(rows, after_id, limit)
+        fast_response.headers.update(headers)
+        return fast_response
+    response.headers.update(headers)
+    items = crud.get_items(db, skip=skip, limit=limit, after_id=after_id)
+    if after_id is None:
+        return items
+    return {"data": items, "next_cursor": next_cursor(items, limit)}
+
+#full-text search over item titles and descriptions, best matches first
+#every word of q has to match, see crud.search_items
+@app.get("/items/search", response_model=list[schemas.Item])
+def search_items(
+    q: str = Query(min_length=1),
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+):
+    return crud.search_items(db, q=q, skip=skip, limit=limit)
+
+@app.get("/items/export")
+def export_items(owner_id: int | None = None):
+    rows = lambda db: crud.iter_items(db, owner_id=owner_id)
+    return StreamingResponse(stream_ndjson(rows, schemas.Item), media_type="application/x-ndjson")
+
+#hit/miss/eviction counters of the user lookup cache
+@app.get("/metrics/cache")
+def read_cache_stats():
+    return {"users": user_cache.stats()}
+
+#how many item writes shared a commit, when group commit is on
+@app.get("/metrics/group_commit")
+def read_group_commit_stats():
+    if crud.item_group_commit is None:
+        return {"enabled": False}
+    return {"enabled": True, **crud.item_group_commit.stats()}
+
+#sessions created vs. requests that asked for one, and connection checkouts per pool
+#held_ms is the time from checkout to checkin of a connection
+@app.get("/metrics/pool")
+def read_pool_stats():
+    return {
+        "sessions": LazySession.stats(),
+        "pools": {name: stats.stats() for name, stats in pool_stats.items()},
+    }
+
+#hit rate of SQLAlchemy's compiled statement cache, see timing.py
+@app.get("/metrics/statements")
+def read_statement_cache_stats():
+    return timing.statement_cache_stats.stats()
+
+#serve the async routes instead when configured
+#"uvicorn main:app" then picks the right app on its own
+if USE_ASYNC_DB:
+    from async_main import app
+#or the sharded ones when SQL_APP_SHARDS is set, see sharding.py
+elif SHARDS:
+    from sharded_main import app
 
 if __name__ == "__main__":
     import uvicorn
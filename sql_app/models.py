@@ -1,5 +1,18 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    String,
+    column,
+    func,
+    inspect,
+    table,
+    text,
+)
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import deferred, relationship
 
 from database import Base
 
@@ -9,8 +22,14 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True)
-    hashed_password = Column(String)
+    #never sent to clients, so loading a User does not select it unless it is accessed
+    hashed_password = deferred(Column(String))
     is_active = Column(Boolean, default=True)
+    #number of items of the user, kept up to date by triggers (see ITEM_COUNT_DDL)
+    item_count = Column(Integer, nullable=False, default=0, server_default="0")
+    #row version for ETags, bumped by triggers on every change of the user or its items (see ROW_VERSION_DDL)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=func.current_timestamp())
 
     items = relationship("Item", back_populates="owner") 
     #this will create a relationship between the user and the item like djangobasic
@@ -21,6 +40,160 @@ class Item(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String, index=True)
     description = Column(String, index=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    #every load of a user's items (selectinload, joinedload, exports) and the counter triggers
+    #look items up by owner_id, without an index each of them scans the whole table
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=func.current_timestamp())
 
-    owner = relationship("User", back_populates="items")
\ No newline at end of file
+    owner = relationship("User", back_populates="items")
+
+#one version per table, for list endpoints that cannot check a single row
+#the "items" row is bumped on every insert, update and delete of items
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime, default=func.current_timestamp())
+
+#full-text search over items with SQLite's FTS5
+#B-tree indexes on title and description only help exact and prefix matches
+#an FTS5 table is an inverted index of the words, so word queries do not scan the table
+#it is an external content table: it stores only the index and reads the text from items
+#the triggers keep it in sync on every insert, update and delete, in the same transaction
+ITEMS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS items_fts
+    USING fts5(title, description, content='items', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    #only when the indexed text changes, items_version_update below runs its own UPDATE of items
+    #(dropped first, so databases with the older "AFTER UPDATE ON items" definition get this one)
+    "DROP TRIGGER IF EXISTS items_fts_update",
+    """CREATE TRIGGER items_fts_update AFTER UPDATE OF title, description ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+#lightweight table construct so queries can join the virtual table
+items_fts = table("items_fts", column("rowid"), column("rank"))
+
+#run after create_all, also works on a database that already has items
+def create_search_index(connection):
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'items_fts'")
+    ).first()
+    for statement in ITEMS_FTS_DDL:
+        connection.execute(text(statement))
+    if not exists:
+        #index the rows that were there before the table existed
+        connection.execute(text("INSERT INTO items_fts(items_fts) VALUES ('rebuild')"))
+
+#create_all does not change tables that already exist
+#this adds the columns that were added to the models since, with their server defaults
+#returns the names of the added columns as "table.column"
+def add_missing_columns(connection):
+    inspector = inspect(connection)
+    added = []
+    for model_table in Base.metadata.sorted_tables:
+        if not inspector.has_table(model_table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(model_table.name)}
+        for model_column in model_table.columns:
+            if model_column.name not in existing:
+                ddl = CreateColumn(model_column).compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {model_table.name} ADD COLUMN {ddl}"))
+                added.append(f"{model_table.name}.{model_column.name}")
+    return added
+
+#create_all does not add indexes to tables that already exist either
+#(e.g. ix_items_owner_id on a database made before owner_id had an index)
+def add_missing_indexes(connection):
+    for model_table in Base.metadata.sorted_tables:
+        for index in model_table.indexes:
+            index.create(connection, checkfirst=True)
+
+#per-user item counts
+#reading a count this way costs one column, instead of loading or counting the user's items
+#the triggers run inside the statement that changes items, so the count is always
+#in the same transaction as the change, whatever code path inserts, moves or deletes items
+ITEM_COUNT_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS items_count_insert AFTER INSERT ON items BEGIN
+        UPDATE users SET item_count = item_count + 1 WHERE id = new.owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_count_delete AFTER DELETE ON items BEGIN
+        UPDATE users SET item_count = item_count - 1 WHERE id = old.owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_count_update AFTER UPDATE OF owner_id ON items
+    WHEN old.owner_id IS NOT new.owner_id BEGIN
+        UPDATE users SET item_count = item_count - 1 WHERE id = old.owner_id;
+        UPDATE users SET item_count = item_count + 1 WHERE id = new.owner_id;
+    END""",
+]
+
+RECOUNT_ITEMS = """UPDATE users SET item_count = (SELECT count(*) FROM items WHERE items.owner_id = users.id)"""
+
+#run after create_all, counts the existing items the first time
+#added are the columns add_missing_columns just added
+def create_item_counters(connection, added: list = ()):
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'items_count_insert'")
+    ).first()
+    for statement in ITEM_COUNT_DDL:
+        connection.execute(text(statement))
+    if not exists or "users.item_count" in added:
+        connection.execute(text(RECOUNT_ITEMS))
+
+#row versions
+#ETag and Last-Modified of GET /users/{user_id} and GET /items/ come from these, so a
+#conditional request only reads one small row instead of loading and serializing the response
+#every UPDATE of a row gets a new version (WHEN ... IS ... skips the UPDATE the trigger itself runs)
+#a user's response lists its items, so any change of its items is a change of the user as well:
+#inserts and deletes already update users.item_count, updates touch the owner here
+ROW_VERSION_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+    WHEN new.version IS old.version BEGIN
+        UPDATE users SET version = old.version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_version_update AFTER UPDATE ON items
+    WHEN new.version IS old.version BEGIN
+        UPDATE items SET version = old.version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = new.id;
+        UPDATE users SET updated_at = CURRENT_TIMESTAMP WHERE id IN (old.owner_id, new.owner_id);
+    END""",
+    "INSERT OR IGNORE INTO table_versions (name, version, updated_at) VALUES ('items', 1, CURRENT_TIMESTAMP)",
+]
+#the UPDATE trigger only watches the columns clients see, so the version bump of items_version_update
+#(which is an UPDATE of items as well) does not count the same change twice
+#it is dropped first, so databases with the older "AFTER UPDATE ON items" definition get this one
+ROW_VERSION_DDL.append("DROP TRIGGER IF EXISTS items_table_version_update")
+for change in ("INSERT", "UPDATE OF id, title, description, owner_id", "DELETE"):
+    ROW_VERSION_DDL.append(
+        f"""CREATE TRIGGER IF NOT EXISTS items_table_version_{change.split()[0].lower()} AFTER {change} ON items BEGIN
+        UPDATE table_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE name = 'items';
+    END"""
+    )
+
+def create_row_versions(connection, added: list = ()):
+    #rows from before updated_at existed (ALTER TABLE cannot add a CURRENT_TIMESTAMP default)
+    #this runs before the triggers exist, so it does not bump any version
+    for name in ("users", "items"):
+        if f"{name}.updated_at" in added:
+            connection.execute(text(f"UPDATE {name} SET updated_at = CURRENT_TIMESTAMP WHERE updated_at IS NULL"))
+    for statement in ROW_VERSION_DDL:
+        connection.execute(text(statement))
+
+#everything that create_all does not do, run after it in one transaction
+#"with engine.begin() as connection: models.prepare_database(connection)"
+def prepare_database(connection):
+    added = add_missing_columns(connection)
+    add_missing_indexes(connection)
+    create_search_index(connection)
+    create_item_counters(connection, added)
+    create_row_versions(connection, added)
\ No newline at end of file
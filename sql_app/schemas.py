@@ -18,6 +18,13 @@ class Item(ItemBase):
         orm_mode = True
 
 
+#a page of items for cursor pagination
+#next_cursor is None when there are no more rows
+class ItemPage(BaseModel):
+    data: list[Item]
+    next_cursor: str | None = None
+
+
 class UserBase(BaseModel):
     email: str
 
@@ -29,7 +36,47 @@ class UserCreate(UserBase):
 class User(UserBase):
     id: int
     is_active: bool
+    item_count: int = 0
+    #row version, changes whenever the user or one of its items changes
+    version: int = 1
     items: list[Item] = []
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class UserPage(BaseModel):
+    data: list[User]
+    next_cursor: str | None = None
+
+
+#one row of a bulk request that could not be created
+#index is the position of the row in the request body
+class BulkRowError(BaseModel):
+    index: int
+    detail: str
+
+
+class UserBulkResult(BaseModel):
+    created: list[User]
+    errors: list[BulkRowError] = []
+
+
+class ItemBulkResult(BaseModel):
+    created: list[Item]
+    errors: list[BulkRowError] = []
+
+
+#a row of GET /users/stats
+class UserItemCount(BaseModel):
+    id: int
+    email: str
+    item_count: int
+
+    class Config:
+        orm_mode = True
+
+
+class UserItemCountPage(BaseModel):
+    data: list[UserItemCount]
+    next_cursor: str | None = None
\ No newline at end of file
@@ -0,0 +1,116 @@
+from fastapi import Depends, FastAPI, HTTPException, Request
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import crud, models, schemas, sharding, timing
+from dependencies import (
+    READ_USER_ITEMS_LOADING,
+    READ_USERS_ITEMS_LOADING,
+    next_cursor,
+    parse_cursor,
+)
+
+#the core routes of main.py on sharded storage, see sharding.py
+#run it with "SQL_APP_SHARDS=4 uvicorn main:app" or "SQL_APP_SHARDS=4 uvicorn sharded_main:app"
+if not sharding.shards:
+    raise RuntimeError("sharded_main needs SQL_APP_SHARDS set to the number of shards")
+
+for shard in sharding.shards:
+    shard.create_schema()
+
+app = FastAPI()
+#Server-Timing header with db, endpoint and FastAPI time for every request, see timing.py
+app.router.route_class = timing.TimedRoute
+app.middleware("http")(timing.add_server_timing)
+
+def open_session(shard: sharding.Shard, request: Request):
+    if request.method in ("GET", "HEAD"):
+        return shard.ReadSessionLocal()
+    return shard.SessionLocal()
+
+#dependencies
+#routes with a user_id get a session on the shard of that user
+def get_db(user_id: int, request: Request):
+    db = open_session(sharding.shard_for_user(user_id), request)
+    try:
+        yield db
+    finally:
+        db.close()
+
+#list routes get a session on every shard
+def get_all_dbs(request: Request):
+    dbs = [open_session(shard, request) for shard in sharding.shards]
+    try:
+        yield dbs
+    finally:
+        for db in dbs:
+            db.close()
+
+#a new user has no id yet, its shard comes from the email
+@app.post("/users/", response_model=schemas.User)
+def create_user(user: schemas.UserCreate, request: Request):
+    bucket = sharding.bucket_for_email(user.email)
+    with open_session(sharding.shards[sharding.shard_of_bucket(bucket)], request) as db:
+        if crud.get_user_by_email(db, email=user.email):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        return sharding.create_user(db, user, bucket)
+
+@app.get("/users/", response_model=list[schemas.User] | schemas.UserPage)
+def read_users(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    dbs: list[Session] = Depends(get_all_dbs),
+):
+    after_id = parse_cursor(after)
+    fetch = lambda db, **page: crud.get_users(db, items_loading=READ_USERS_ITEMS_LOADING, **page)
+    users = sharding.merge_pages(dbs, fetch, skip=skip, limit=limit, after_id=after_id)
+    if after_id is None:
+        return users
+    return {"data": users, "next_cursor": next_cursor(users, limit)}
+
+@app.get("/users/{user_id}", response_model=schemas.User)
+def read_user(user_id: int, db: Session = Depends(get_db)):
+    db_user = crud.get_user(db, user_id=user_id, items_loading=READ_USER_ITEMS_LOADING)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+@app.post("/users/{user_id}/items/", response_model=schemas.Item)
+def create_item_for_user(
+    user_id: int, item: schemas.ItemCreate, db: Session = Depends(get_db)
+):
+    return sharding.create_user_item(db, item, user_id)
+
+@app.get("/items/", response_model=list[schemas.Item] | schemas.ItemPage)
+def read_items(
+    skip: int = 0,
+    limit: int = 100,
+    after: str | None = None,
+    dbs: list[Session] = Depends(get_all_dbs),
+):
+    after_id = parse_cursor(after)
+    items = sharding.merge_pages(dbs, crud.get_items, skip=skip, limit=limit, after_id=after_id)
+    if after_id is None:
+        return items
+    return {"data": items, "next_cursor": next_cursor(items, limit)}
+
+#rows per shard, to see how even the split is
+@app.get("/metrics/shards")
+def read_shard_stats(dbs: list[Session] = Depends(get_all_dbs)):
+    return [
+        {
+            "shard": number,
+            "users": db.scalar(select(func.count()).select_from(models.User)),
+            "items": db.scalar(select(func.count()).select_from(models.Item)),
+        }
+        for number, db in enumerate(dbs)
+    ]
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app)
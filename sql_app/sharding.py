@@ -0,0 +1,165 @@
+#hash-sharded storage
+#one SQLite file takes one write at a time, so with SQL_APP_SHARDS=N users and their items
+#are split over N files, each with its own engine and pool, so N writes can run at once
+#run the app with "SQL_APP_SHARDS=4 uvicorn main:app" (see sharded_main.py)
+
+#rows are placed by bucket, not directly by shard
+#there are BUCKETS buckets and bucket b lives on shard b % N
+#a new user gets the bucket of the hash of its email (so one email always lands on the same shard
+#and the unique index on email still catches duplicates), and the bucket is stored in the id itself:
+#id % BUCKETS is the bucket, so any user_id can be routed without a lookup table
+#items get ids in the bucket of their owner, so a user and its items always share a shard
+#changing N only moves whole buckets, see rebalance() below
+
+import argparse
+import heapq
+import os
+import zlib
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm.attributes import set_committed_value
+
+import models, timing
+from database import ENGINE_MODE, create_engines, create_sessionmakers
+
+BUCKETS = 1024
+SHARDS = int(os.environ.get("SQL_APP_SHARDS", "0"))
+#{shard} is replaced by the shard number
+SHARD_URL = os.environ.get("SQL_APP_SHARD_URL", "sqlite:///./sql_app_shard{shard}.db")
+
+
+class Shard:
+    def __init__(self, number: int, url: str, mode: str = "default"):
+        self.number = number
+        self.engine, self.read_engine = create_engines(url, mode)
+        timing.instrument(self.engine)
+        if self.read_engine is not self.engine:
+            timing.instrument(self.read_engine)
+        self.SessionLocal, self.ReadSessionLocal = create_sessionmakers(self.engine, self.read_engine)
+
+    #the same tables, search index and counters as the single database
+    def create_schema(self):
+        models.Base.metadata.create_all(bind=self.engine)
+        with self.engine.begin() as connection:
+            models.prepare_database(connection)
+
+
+def open_shards(count: int, url: str = SHARD_URL, mode: str = ENGINE_MODE):
+    return [Shard(number, url.format(shard=number), mode) for number in range(count)]
+
+#empty when sharding is off
+shards = open_shards(SHARDS)
+
+
+def bucket_for_email(email: str):
+    #crc32 is stable between processes and Python versions, unlike hash()
+    return zlib.crc32(email.encode()) % BUCKETS
+
+def bucket_of(row_id: int):
+    return row_id % BUCKETS
+
+def shard_of_bucket(bucket: int, count: int = SHARDS):
+    return bucket % count
+
+def shard_for_user(user_id: int):
+    return shards[shard_of_bucket(bucket_of(user_id))]
+
+def shard_for_email(email: str):
+    return shards[shard_of_bucket(bucket_for_email(email))]
+
+
+#the next id of a bucket is taken inside the INSERT itself
+#so it is atomic even with several processes writing to the same shard
+#it is above every id on the shard, which also covers buckets that were moved here by a rebalance
+def next_id(model, bucket: int):
+    top = select(func.coalesce(func.max(model.id), 0)).scalar_subquery()
+    return (top // BUCKETS + 1) * BUCKETS + bucket
+
+
+def create_user(db, user, bucket: int):
+    row = {"email": user.email, "hashed_password": user.password + "notreallyhashed"}
+    stmt = insert(models.User).values(id=next_id(models.User, bucket), **row).returning(models.User)
+    db_user = db.scalar(stmt)
+    db.commit()
+    set_committed_value(db_user, "items", [])
+    return db_user
+
+
+def create_user_item(db, item, user_id: int):
+    row = {**item.dict(), "owner_id": user_id}
+    stmt = insert(models.Item).values(id=next_id(models.Item, bucket_of(user_id)), **row).returning(models.Item)
+    db_item = db.scalar(stmt)
+    db.commit()
+    return db_item
+
+
+#list endpoints ask every shard for a page in id order and merge them by id
+#with a cursor each shard only returns limit rows after it
+#with skip each shard has to return skip + limit rows, so deep skips cost N times more than on one file
+def merge_pages(dbs: list, fetch, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    if after_id is None:
+        pages = [fetch(db, limit=skip + limit, after_id=0) for db in dbs]
+    else:
+        skip = 0
+        pages = [fetch(db, limit=limit, after_id=after_id) for db in dbs]
+    merged = heapq.merge(*pages, key=lambda row: row.id)
+    return list(merged)[skip:skip + limit]
+
+
+#rebalancing from SQL_APP_SHARDS shards to a new count
+#stop the app first, run "python sharding.py rebalance --to 8", then start it with SQL_APP_SHARDS=8
+#every bucket whose shard changes is copied to its new shard and then deleted from the old one,
+#one transaction each, so an interrupted run can simply be started again:
+#the copy first clears whatever an earlier attempt left of the bucket on the new shard
+def move_bucket(bucket: int, source: Shard, target: Shard):
+    users = models.User.__table__
+    items = models.Item.__table__
+    #item_count is left out, the counter triggers on the new shard count the items as they come in
+    user_columns = [c for c in users.columns if c.name != "item_count"]
+    in_bucket_users = users.c.id % BUCKETS == bucket
+    in_bucket_items = items.c.id % BUCKETS == bucket
+    with source.engine.connect() as connection:
+        user_rows = [row._asdict() for row in connection.execute(select(*user_columns).where(in_bucket_users))]
+        item_rows = [row._asdict() for row in connection.execute(select(items).where(in_bucket_items))]
+    if not user_rows and not item_rows:
+        return 0, 0
+    with target.engine.begin() as connection:
+        connection.execute(delete(items).where(in_bucket_items))
+        connection.execute(delete(users).where(in_bucket_users))
+        if user_rows:
+            connection.execute(insert(users), user_rows)
+        if item_rows:
+            connection.execute(insert(items), item_rows)
+    with source.engine.begin() as connection:
+        connection.execute(delete(items).where(in_bucket_items))
+        connection.execute(delete(users).where(in_bucket_users))
+    return len(user_rows), len(item_rows)
+
+
+def rebalance(old_count: int, new_count: int, url: str = SHARD_URL):
+    all_shards = open_shards(max(old_count, new_count), url)
+    for shard in all_shards:
+        shard.create_schema()
+    moved_users = moved_items = 0
+    for bucket in range(BUCKETS):
+        old = shard_of_bucket(bucket, old_count)
+        new = shard_of_bucket(bucket, new_count)
+        if old != new:
+            users, items = move_bucket(bucket, all_shards[old], all_shards[new])
+            moved_users += users
+            moved_items += items
+    print(f"moved {moved_users} users and {moved_items} items from {old_count} to {new_count} shards")
+    for shard in all_shards[new_count:]:
+        print(f"shard {shard.number} is empty now and can be removed: {shard.engine.url}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sharded storage tools")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    rebalance_parser = subcommands.add_parser("rebalance", help="move buckets to a new number of shards")
+    rebalance_parser.add_argument("--from", dest="old", type=int, default=SHARDS, help="current shard count")
+    rebalance_parser.add_argument("--to", dest="new", type=int, required=True, help="new shard count")
+    args = parser.parse_args()
+    if args.old < 1 or args.new < 1:
+        parser.error("shard counts have to be at least 1")
+    rebalance(args.old, args.new)
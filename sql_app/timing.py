@@ -0,0 +1,171 @@
+#request-scoped timings for the Server-Timing header
+#the middleware puts a RequestTimings in a context variable at the start of each request
+#SQLAlchemy engine events (see instrument) and TimedRoute add to it while the request runs
+#context variables are copied into the threadpool, so sync routes see the same object
+
+import inspect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import CacheStats
+
+#requests slower than this are logged with their database numbers
+SLOW_REQUEST_MS = float(os.environ.get("SQL_APP_SLOW_REQUEST_MS", "500"))
+
+logger = logging.getLogger("sql_app.timing")
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        #time spent in the path operation function and in the whole route
+        #(route = endpoint + parameter validation + response serialization)
+        self.endpoint_time = 0.0
+        self.route_time = 0.0
+
+    def add_statement(self, statement: str, duration: float):
+        self.statements += 1
+        self.db_time += duration
+        if duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+
+    def server_timing(self, total: float):
+        fastapi_time = max(self.route_time - self.endpoint_time, 0.0)
+        endpoint_time = max(self.endpoint_time - self.db_time, 0.0)
+        metrics = [
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.statements} statements"',
+            f"db-slowest;dur={self.slowest_time * 1000:.2f}",
+            f'app;dur={endpoint_time * 1000:.2f};desc="endpoint without db"',
+            f'fastapi;dur={fastapi_time * 1000:.2f};desc="validation and serialization"',
+            f"total;dur={total * 1000:.2f}",
+        ]
+        return ", ".join(metrics)
+
+current_timings: ContextVar[RequestTimings | None] = ContextVar("current_timings", default=None)
+
+#outcome of SQLAlchemy's compiled statement cache for every statement sent to the database
+#a hit reuses the SQL string compiled for an earlier execution of the same statement
+#a miss compiles it, statements without a cache key (e.g. some raw SQL) are always compiled
+class StatementCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {outcome.name.lower(): 0 for outcome in CacheStats}
+
+    def add(self, cache_hit):
+        if cache_hit is None:
+            return
+        with self._lock:
+            self.counts[CacheStats(cache_hit).name.lower()] += 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        compiled = counts["cache_hit"] + counts["cache_miss"]
+        counts["hit_rate"] = round(counts["cache_hit"] / compiled, 4) if compiled else 0.0
+        return counts
+
+statement_cache_stats = StatementCacheStats()
+
+#hooks SQLAlchemy engine events, called for every engine in database.py
+#statements that run outside of a request (startup, scripts) are ignored
+def instrument(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        statement_cache_stats.add(getattr(context, "cache_hit", None))
+        timings = current_timings.get()
+        if timings is not None:
+            timings.add_statement(statement, time.perf_counter() - start)
+
+    #a failed statement never reaches after_cursor_execute
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+#middleware that adds the Server-Timing header and logs slow requests
+async def add_server_timing(request: Request, call_next):
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        response = await call_next(request)
+    finally:
+        current_timings.reset(token)
+    total = time.perf_counter() - timings.start
+    response.headers["Server-Timing"] = timings.server_timing(total)
+    if total * 1000 >= SLOW_REQUEST_MS:
+        logger.warning(
+            "slow request %s %s: %.1f ms total, %.1f ms db in %d statements, slowest %.1f ms: %s",
+            request.method,
+            request.url.path,
+            total * 1000,
+            timings.db_time * 1000,
+            timings.statements,
+            timings.slowest_time * 1000,
+            " ".join((timings.slowest_statement or "").split())[:300],
+        )
+    return response
+
+#measures the route and the path operation function on their own
+#use it with app.router.route_class = TimedRoute before the routes are declared
+class TimedRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request):
+            start = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                timings = current_timings.get()
+                if timings is not None:
+                    timings.route_time += time.perf_counter() - start
+
+        return timed_handler
+
+#wraps keeps the signature, so FastAPI still sees the same parameters
+#and an async endpoint stays async (a sync one still runs in the threadpool)
+def timed_endpoint(endpoint):
+    if inspect.iscoroutinefunction(endpoint):
+        @wraps(endpoint)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                add_endpoint_time(start)
+    else:
+        @wraps(endpoint)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                add_endpoint_time(start)
+    return timed
+
+
+def add_endpoint_time(start: float):
+    timings = current_timings.get()
+    if timings is not None:
+        timings.endpoint_time += time.perf_counter() - start
@@ -0,0 +1,589 @@
+#tests, run with "python -m pytest" from this directory
+#and with "SQL_APP_ENGINE_MODE=wal python -m pytest" for sql_app's writer and read-only pools
+#each test builds a small app of its own, fastapibasic.py itself does not import without its static folder
+
+import asyncio
+import gzip
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.testclient import TestClient
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from inline_deps import route_dispatches
+from passwords import PasswordPool, PasswordPoolBusy
+from prebuilt_openapi import build, use_prebuilt_openapi
+from rate_limit import RateLimit, RateLimiter, RateLimitMiddleware, SharedTokenBuckets
+from token_cache import VerifiedTokenCache
+
+#sql_app imports its modules by name and reads its settings when it is imported
+#so its folder goes on sys.path and its database is a temp file, set before the first import
+os.environ["SQL_APP_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "sql_app_test.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql_app"))
+
+import crud, database, main, models, schemas, sharding
+from group_commit import GroupCommitter
+
+
+#rate limiting
+
+def login_client(tmp_path, limits):
+    app = FastAPI()
+
+    @app.post("/login")
+    async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
+        return {"username": form_data.username}
+
+    buckets = SharedTokenBuckets(str(tmp_path / "buckets"), slots=64)
+    limiter = RateLimiter(routes={"/login": limits}, buckets=buckets)
+    app.add_middleware(RateLimitMiddleware, limiter=limiter, max_form_size=1024)
+    return TestClient(app)
+
+def username_limit_statuses(client, send, attempts=5):
+    return [send(client).status_code for _ in range(attempts)]
+
+def test_username_limit_urlencoded(tmp_path):
+    client = login_client(tmp_path, [RateLimit.per_minute(3, key="username")])
+    send = lambda client: client.post("/login", data={"username": "bob", "password": "guess"})
+    assert username_limit_statuses(client, send) == [200, 200, 200, 429, 429]
+    response = send(client)
+    assert response.headers["retry-after"] == "20"
+    #other users are not limited by bob's bucket
+    assert client.post("/login", data={"username": "alice", "password": "guess"}).status_code == 200
+
+def test_username_limit_multipart(tmp_path):
+    client = login_client(tmp_path, [RateLimit.per_minute(3, key="username")])
+    send = lambda client: client.post("/login", files={"username": (None, "bob"), "password": (None, "guess")})
+    response = send(client)
+    #the app still gets the whole body after the middleware read it
+    assert response.json() == {"username": "bob"}
+    assert username_limit_statuses(client, send, 4) == [200, 200, 429, 429]
+
+def test_username_limit_chunked(tmp_path):
+    client = login_client(tmp_path, [RateLimit.per_minute(3, key="username")])
+
+    def send(client):
+        chunks = iter([b"username=b", b"ob&password=guess"])
+        return client.post("/login", content=chunks, headers={"content-type": "application/x-www-form-urlencoded"})
+
+    assert send(client).json() == {"username": "bob"}
+    assert username_limit_statuses(client, send, 4) == [200, 200, 429, 429]
+
+def test_username_limit_counts_the_username_the_app_reads(tmp_path):
+    client = login_client(tmp_path, [RateLimit.per_minute(3, key="username")])
+    #the app reads the last value, decoys in front of it must not get fresh buckets
+    responses = [
+        client.post("/login", content=f"username=decoy{n}&username=bob&password=guess",
+                    headers={"content-type": "application/x-www-form-urlencoded"})
+        for n in range(5)
+    ]
+    assert responses[0].json() == {"username": "bob"}
+    assert [response.status_code for response in responses] == [200, 200, 200, 429, 429]
+    multipart = [
+        client.post("/login", files=[("username", (None, f"decoy{n}")), ("username", (None, "carol")), ("password", (None, "guess"))])
+        for n in range(5)
+    ]
+    assert multipart[0].json() == {"username": "carol"}
+    assert [response.status_code for response in multipart] == [200, 200, 200, 429, 429]
+
+def test_unreadable_username_is_still_limited(tmp_path):
+    client = login_client(tmp_path, [RateLimit.per_minute(3, key="username")])
+    oversized = "x" * 2048
+    statuses = [
+        client.post("/login", data={"username": f"user{n}", "password": oversized}).status_code
+        for n in range(4)
+    ]
+    assert statuses == [200, 200, 200, 429]
+
+def test_buckets_are_shared_through_the_file(tmp_path):
+    first = SharedTokenBuckets(str(tmp_path / "buckets"), slots=64)
+    second = SharedTokenBuckets(str(tmp_path / "buckets"), slots=1024)
+    #the second one maps the file the first one created, with its size
+    assert second.slots == 64
+    assert first.take("client", rate=0.01, burst=2) == 0.0
+    assert second.take("client", rate=0.01, burst=2) == 0.0
+    assert first.take("client", rate=0.01, burst=2) > 0
+
+
+
+#password pool
+
+def test_password_pool_limits_rejects_and_recovers():
+    pool = PasswordPool(workers=1, max_queue=1)
+
+    async def scenario():
+        #one call runs, one waits for the worker, the third is turned away
+        results = await asyncio.gather(
+            pool.run(time.sleep, 0.5), pool.run(time.sleep, 0.5), pool.run(time.sleep, 0.5), return_exceptions=True
+        )
+        assert [isinstance(result, PasswordPoolBusy) for result in results] == [False, False, True]
+        assert pool.stats()["rejected"] == 1
+        #a worker killed from outside (e.g. by the OOM killer) breaks the executor
+        pid = await pool.run(os.getpid)
+        os.kill(pid, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+        assert await pool.run(os.getpid) != pid
+        assert pool.stats()["restarts"] == 1
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        pool.executor().shutdown()
+
+
+
+#token cache
+
+def test_token_cache_keeps_tokens_until_exp_or_max_ttl():
+    cache = VerifiedTokenCache(maxsize=10, max_ttl=60)
+    cache.put("expired", "alice", time.time() - 1)
+    assert cache.get("expired") is None
+    #a signed token without an exp claim is valid, it is kept for max_ttl
+    cache.put("no exp", "bob", None)
+    assert cache.get("no exp") == "bob"
+    cache = VerifiedTokenCache(maxsize=10, max_ttl=0)
+    cache.put("no exp", "bob", None)
+    assert cache.get("no exp") is None
+
+
+#sql_app
+
+def test_only_selects_go_to_the_read_only_pool():
+    writes = [crud.RECOUNT_ITEMS, text("UPDATE items SET title = 'x'"), text(" insert into items (title) values ('x')"),
+              text("WITH ids AS (SELECT 1) DELETE FROM items WHERE id IN ids")]
+    reads = [crud.USER_BY_EMAIL, text("SELECT 1"), text("\n  explain query plan select 1"), None]
+    for clause in writes:
+        session = database.RoutingSession(writer="writer", reader="reader")
+        assert session.get_bind(clause=clause) == "writer"
+    for clause in reads:
+        session = database.RoutingSession(writer="writer", reader="reader")
+        assert session.get_bind(clause=clause) == "reader"
+
+def test_recompute_item_counts():
+    db = database.SessionLocal()
+    try:
+        user = crud.create_user(db, schemas.UserCreate(email="recount@example.com", password="secret"))
+        crud.create_user_item(db, schemas.ItemCreate(title="one"), user.id)
+        db.execute(models.User.__table__.update().where(models.User.id == user.id).values(item_count=7))
+        db.commit()
+        assert (user.id, 7, 1) in crud.find_item_count_mismatches(db)
+        crud.recompute_item_counts(db)
+        assert crud.find_item_count_mismatches(db) == []
+    finally:
+        db.close()
+
+def count_statements(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    return statements, lambda: event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def test_bulk_users_report_duplicates_by_index():
+    client = TestClient(main.app)
+    client.post("/users/", json={"email": "bulk-taken@example.com", "password": "secret"})
+    emails = ["bulk1@example.com", "bulk-taken@example.com", "bulk2@example.com", "bulk1@example.com"]
+    result = client.post("/users/bulk", json=[{"email": email, "password": "secret"} for email in emails]).json()
+    assert [user["email"] for user in result["created"]] == ["bulk1@example.com", "bulk2@example.com"]
+    #already in the table and twice in one batch
+    assert result["errors"] == [
+        {"index": 1, "detail": "Email already registered"},
+        {"index": 3, "detail": "Email already registered"},
+    ]
+    owner = result["created"][0]["id"]
+    items = client.post(f"/users/{owner}/items/bulk", json=[{"title": "a"}, {"title": "b", "description": "c"}]).json()
+    assert [item["title"] for item in items["created"]] == ["a", "b"] and items["errors"] == []
+    assert client.get(f"/users/{owner}").json()["item_count"] == 2
+
+def test_bulk_users_fall_back_to_one_by_one_after_a_race():
+    client = TestClient(main.app)
+    raced = "bulk-raced@example.com"
+
+    registered = []
+
+    #registers the email right after the duplicate check of the batch ran, like another request would
+    def register_after_check(conn, cursor, statement, parameters, context, executemany):
+        if "users.email IN" in statement and not registered:
+            registered.append(raced)
+            with database.engine.begin() as connection:
+                connection.execute(
+                    text("INSERT INTO users (email, hashed_password, is_active) VALUES (:email, 'x', 1)"), {"email": raced}
+                )
+
+    event.listen(database.read_engine, "after_cursor_execute", register_after_check)
+    try:
+        emails = ["race1@example.com", raced, "race2@example.com"]
+        result = client.post("/users/bulk", json=[{"email": email, "password": "secret"} for email in emails]).json()
+    finally:
+        event.remove(database.read_engine, "after_cursor_execute", register_after_check)
+    assert registered
+    #the batch INSERT failed on the raced email, the other rows went in from their own savepoints
+    assert [user["email"] for user in result["created"]] == ["race1@example.com", "race2@example.com"]
+    assert result["errors"] == [{"index": 1, "detail": "Email already registered"}]
+
+def test_users_page_statement_count_does_not_grow_with_the_page():
+    client = TestClient(main.app)
+    for n in range(50):
+        user = client.post("/users/", json={"email": f"page{n}@example.com", "password": "secret"}).json()
+        client.post(f"/users/{user['id']}/items/bulk", json=[{"title": f"item {n}"}, {"title": f"other {n}"}])
+    counts = {}
+    statements, stop = count_statements(database.engine)
+    try:
+        for limit in (5, 50):
+            statements.clear()
+            users = client.get("/users/", params={"limit": limit}).json()
+            assert len(users) == limit
+            assert all(len(user["items"]) == user["item_count"] for user in users)
+            counts[limit] = len(statements)
+    finally:
+        stop()
+    #the users and then all of their items, not one query per user
+    assert counts[5] == counts[50]
+
+def test_items_are_looked_up_by_owner_with_an_index():
+    with database.engine.connect() as connection:
+        plan = connection.execute(text("EXPLAIN QUERY PLAN SELECT * FROM items WHERE owner_id IN (1, 2)")).all()
+    assert "ix_items_owner_id" in " ".join(row[-1] for row in plan)
+
+def test_export_streams_one_chunk_per_batch():
+    client = TestClient(main.app)
+    user = client.post("/users/", json={"email": "export@example.com", "password": "secret"}).json()
+    client.post(f"/users/{user['id']}/items/bulk", json=[{"title": f"export {n}"} for n in range(5)])
+    rows = lambda db: crud.iter_items(db, owner_id=user["id"], batch_size=2)
+    chunks = list(main.stream_ndjson(rows, schemas.Item))
+    #every chunk is one batch of lines, so the threadpool is entered once per batch and not per row
+    assert [chunk.count("\n") for chunk in chunks] == [2, 2, 1]
+    lines = client.get("/items/export", params={"owner_id": user["id"]}).text.splitlines()
+    assert len(lines) == 5
+
+def test_sparse_fieldsets_keep_the_page_order():
+    client = TestClient(main.app)
+    for email in ("zz-order@example.com", "aa-order@example.com", "mm-order@example.com"):
+        client.post("/users/", json={"email": email, "password": "secret"})
+    full = [user["id"] for user in client.get("/users/", params={"limit": 1000}).json()]
+    sparse = [user["id"] for user in client.get("/users/", params={"limit": 1000, "fields": "email"}).json()]
+    assert sparse == full == sorted(full)
+    paged = [user["id"] for user in client.get("/users/", params={"skip": 2, "limit": 3, "fields": "email"}).json()]
+    assert paged == full[2:5]
+    items = [item["id"] for item in client.get("/items/", params={"limit": 1000, "fields": "title"}).json()]
+    assert items == sorted(items)
+
+def test_an_item_update_bumps_each_version_once():
+    db = database.SessionLocal()
+    try:
+        user = crud.create_user(db, schemas.UserCreate(email="versions@example.com", password="secret"))
+        item = crud.create_user_item(db, schemas.ItemCreate(title="before"), user.id)
+        table_version = db.execute(text("SELECT version FROM table_versions WHERE name = 'items'")).scalar()
+        db.execute(text("UPDATE items SET description = 'after' WHERE id = :id"), {"id": item.id})
+        db.commit()
+        assert db.execute(text("SELECT version FROM table_versions WHERE name = 'items'")).scalar() == table_version + 1
+        assert db.execute(text("SELECT version FROM items WHERE id = :id"), {"id": item.id}).scalar() == item.version + 1
+        #the search index has the new text once, not a second copy from the version bump
+        matches = db.execute(text("SELECT count(*) FROM items_fts WHERE items_fts MATCH 'after'")).scalar()
+        assert matches == 1
+    finally:
+        db.close()
+
+def test_out_of_range_cursors_are_a_client_error():
+    client = TestClient(main.app)
+    for last_id in ("9" * 30, str(2**63), "-1"):
+        cursor = crud.encode_cursor(last_id)
+        assert client.get("/users/", params={"after": cursor}).status_code == 400
+        assert client.get("/items/", params={"after": cursor}).status_code == 400
+    assert client.get("/items/", params={"after": crud.encode_cursor(2**63 - 1)}).json()["data"] == []
+
+def test_users_registered_elsewhere_are_seen_at_once():
+    client = TestClient(main.app)
+    email = "elsewhere@example.com"
+    #both lookups miss first, like in a worker that has not seen the new user yet
+    assert client.get("/users/900001").status_code == 404
+    db = database.SessionLocal()
+    try:
+        assert not crud.email_registered(db, email)
+    finally:
+        db.close()
+    #registered behind the app's back, like another worker or the async app would
+    with database.engine.begin() as connection:
+        connection.execute(
+            text("INSERT INTO users (id, email, hashed_password, is_active) VALUES (900001, :email, 'x', 1)"), {"email": email}
+        )
+    response = client.post("/users/", json={"email": email, "password": "secret"})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Email already registered"}
+    assert client.get("/users/900001").json()["email"] == email
+
+def test_db_routes_cost_two_threadpool_dispatches():
+    for route in main.app.routes:
+        if route.path in ("/users/", "/users/{user_id}", "/items/"):
+            #one sync generator dependency, entered and exited once
+            assert route_dispatches(route.dependant) == [("get_db", 2)]
+
+class PoolCheck(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+    checked_out: int
+
+def test_read_connection_is_released_before_serialization():
+    app = FastAPI()
+    app.router.route_class = main.SessionRoute
+
+    class Answer:
+        #read while the response is serialized
+        @property
+        def checked_out(self):
+            return database.read_engine.pool.checkedout()
+
+    @app.get("/check", response_model=PoolCheck)
+    def check(db=Depends(main.get_db)):
+        db.execute(text("SELECT 1"))
+        assert database.read_engine.pool.checkedout() == 1
+        return Answer()
+
+    assert TestClient(app).get("/check").json() == {"checked_out": 0}
+
+
+#group commit
+
+def write_test_user(db, email):
+    return crud.insert_returning(db, models.User, [{"email": email, "hashed_password": "x"}])[0]
+
+def submit_together(committer, *emails):
+    with ThreadPoolExecutor(len(emails)) as pool:
+        futures = [pool.submit(committer.submit, email) for email in emails]
+        return [future.exception() or future.result().email for future in futures]
+
+def test_group_commit_fails_only_the_bad_row():
+    crud.create_user(database.SessionLocal(), schemas.UserCreate(email="taken@example.com", password="x"))
+    committer = GroupCommitter(database.SessionLocal, write_test_user, max_delay_ms=300, max_rows=10)
+    results = submit_together(committer, "group1@example.com", "taken@example.com", "group2@example.com")
+    assert results[0] == "group1@example.com" and results[2] == "group2@example.com"
+    assert isinstance(results[1], IntegrityError)
+    assert committer.stats()["batches"] == 1
+
+def test_group_commit_batches_by_rows_and_delay():
+    committer = GroupCommitter(database.SessionLocal, write_test_user, max_delay_ms=300, max_rows=2)
+    emails = [f"rows{n}@example.com" for n in range(5)]
+    assert submit_together(committer, *emails) == emails
+    assert committer.stats() == {"batches": 3, "rows": 5, "rows_per_batch": 5 / 3}
+    started = time.perf_counter()
+    committer.submit("delay@example.com")
+    #a lone write waits for others until max_delay_ms
+    assert 0.29 <= time.perf_counter() - started < 2
+
+def test_a_failed_group_commit_reaches_every_caller_and_the_thread_survives():
+    def failed_commit():
+        raise OperationalError("COMMIT", {}, Exception("disk I/O error"))
+
+    def failed_rollback():
+        raise RuntimeError("rollback failed")
+
+    def failing_session():
+        db = database.SessionLocal()
+        db.commit = failed_commit
+        return db
+
+    committer = GroupCommitter(failing_session, write_test_user, max_delay_ms=300, max_rows=10)
+    results = submit_together(committer, "lost1@example.com", "lost2@example.com")
+    assert [type(result) for result in results] == [OperationalError, OperationalError]
+
+    #the rollback after it fails as well, out of _flush
+    def broken_session():
+        db = failing_session()
+        db.rollback = failed_rollback
+        return db
+
+    committer.session_factory = broken_session
+    results = submit_together(committer, "lost1@example.com", "lost2@example.com")
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
+    committer.session_factory = database.SessionLocal
+    assert committer.submit("after@example.com").email == "after@example.com"
+    with database.SessionLocal() as db:
+        assert not crud.email_registered(db, "lost1@example.com")
+
+def test_a_queued_group_write_times_out_unwritten():
+    release = threading.Event()
+
+    def slow_write(db, email):
+        release.wait(5)
+        return write_test_user(db, email)
+
+    committer = GroupCommitter(database.SessionLocal, slow_write, max_delay_ms=0, max_rows=1, timeout=0.3)
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(committer.submit, "slow@example.com")
+        time.sleep(0.1)
+        #the thread is busy with the first batch, this one stays queued and is taken back
+        with pytest.raises(TimeoutError):
+            committer.submit("queued@example.com")
+        release.set()
+        #the first one was already in its batch, it waits for the commit past the timeout
+        assert first.result().email == "slow@example.com"
+    assert committer.submit("next@example.com").email == "next@example.com"
+    with database.SessionLocal() as db:
+        assert not crud.email_registered(db, "queued@example.com")
+
+
+#sharded storage
+
+def open_test_shards(tmp_path, count):
+    shards = sharding.open_shards(count, f"sqlite:///{tmp_path}/shard{{shard}}.db", "default")
+    for shard in shards:
+        shard.create_schema()
+    return shards
+
+def fill_shards(shards, users=40, items=2):
+    for n in range(users):
+        email = f"shard{n}@example.com"
+        bucket = sharding.bucket_for_email(email)
+        with shards[sharding.shard_of_bucket(bucket, len(shards))].SessionLocal() as db:
+            user = sharding.create_user(db, schemas.UserCreate(email=email, password="secret"), bucket)
+            for number in range(items):
+                sharding.create_user_item(db, schemas.ItemCreate(title=f"item {number}"), user.id)
+
+#every user is on the shard its id routes to, with its items and their count, and nowhere else
+def assert_routed(shards, users=40, items=2):
+    found = 0
+    for number, shard in enumerate(shards):
+        with shard.SessionLocal() as db:
+            for user in db.scalars(select(models.User)):
+                assert sharding.shard_of_bucket(sharding.bucket_of(user.id), len(shards)) == number
+                assert sharding.bucket_of(user.id) == sharding.bucket_for_email(user.email)
+                assert user.item_count == len(user.items) == items
+                assert all(sharding.bucket_of(item.id) == sharding.bucket_of(user.id) for item in user.items)
+                found += 1
+    assert found == users
+
+def test_rebalance_moves_users_to_the_shard_their_id_routes_to(tmp_path):
+    url = f"sqlite:///{tmp_path}/shard{{shard}}.db"
+    fill_shards(open_test_shards(tmp_path, 3))
+    sharding.rebalance(3, 5, url)
+    shards = open_test_shards(tmp_path, 5)
+    assert_routed(shards)
+    #new ids keep the bucket of their owner next to the moved rows
+    with shards[0].SessionLocal() as db:
+        user = db.scalars(select(models.User)).first()
+        item = sharding.create_user_item(db, schemas.ItemCreate(title="after"), user.id)
+        assert sharding.bucket_of(item.id) == sharding.bucket_of(user.id)
+        db.delete(item)
+        db.commit()
+    sharding.rebalance(5, 2, url)
+    assert_routed(open_test_shards(tmp_path, 2))
+
+def bucket_totals(shard, bucket):
+    with shard.engine.connect() as connection:
+        return tuple(connection.execute(
+            text("SELECT count(*), sum(item_count) FROM users WHERE id % :buckets = :bucket"),
+            {"buckets": sharding.BUCKETS, "bucket": bucket},
+        ).one())
+
+def test_an_interrupted_move_can_run_again(tmp_path, monkeypatch):
+    shards = open_test_shards(tmp_path, 5)
+    fill_shards(shards[:3])
+    buckets = [sharding.bucket_for_email(f"shard{n}@example.com") for n in range(40)]
+    bucket = next(bucket for bucket in buckets if bucket % 3 != bucket % 5)
+    source, target = shards[bucket % 3], shards[bucket % 5]
+    #the copy is committed on the target, then the run stops before the source is cleared
+    real_delete = sharding.delete
+    calls = []
+
+    def interrupted_delete(table):
+        calls.append(table)
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        return real_delete(table)
+
+    monkeypatch.setattr(sharding, "delete", interrupted_delete)
+    with pytest.raises(KeyboardInterrupt):
+        sharding.move_bucket(bucket, source, target)
+    monkeypatch.setattr(sharding, "delete", real_delete)
+    users, counted = bucket_totals(source, bucket)
+    assert users and counted == users * 2
+    assert bucket_totals(target, bucket) == (users, counted)
+    #run again: the copy on the target is replaced, not doubled, and the source is cleared
+    assert sharding.move_bucket(bucket, source, target) == (users, users * 2)
+    assert bucket_totals(target, bucket) == (users, users * 2)
+    assert bucket_totals(source, bucket) == (0, None)
+
+def test_pages_are_merged_by_id_across_shards(tmp_path):
+    shards = open_test_shards(tmp_path, 3)
+    fill_shards(shards)
+    dbs = [shard.SessionLocal() for shard in shards]
+    try:
+        ids = sorted(user.id for db in dbs for user in crud.get_users(db, limit=1000))
+        fetch = lambda db, **page: crud.get_users(db, **page)
+        for skip, limit in ((0, 7), (5, 10), (35, 10)):
+            page = sharding.merge_pages(dbs, fetch, skip=skip, limit=limit)
+            assert [user.id for user in page] == ids[skip:skip + limit]
+        walked = []
+        after_id = 0
+        while True:
+            page = sharding.merge_pages(dbs, fetch, limit=6, after_id=after_id)
+            walked.extend(user.id for user in page)
+            if len(page) < 6:
+                break
+            after_id = page[-1].id
+        assert walked == ids
+        items = sharding.merge_pages(dbs, crud.get_items, skip=3, limit=20)
+        assert [item.id for item in items] == sorted(item.id for db in dbs for item in crud.get_items(db, limit=1000))[3:23]
+    finally:
+        for db in dbs:
+            db.close()
+
+
+#prebuilt OpenAPI schema
+
+def items_app(limit_type=int):
+    app = FastAPI()
+
+    @app.get("/items/", tags=["items"])
+    async def read_items(limit: limit_type = 10):
+        return []
+
+    return app
+
+def test_prebuilt_openapi_is_served_compressed_with_an_etag(tmp_path):
+    build(items_app(), "items", str(tmp_path))
+    app = items_app()
+    assert use_prebuilt_openapi(app, "items", "require", str(tmp_path))
+    client = TestClient(app)
+    response = client.get("/openapi.json", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json()["paths"]["/items/"]["get"]["tags"] == ["items"]
+    assert client.get("/openapi.json", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    plain = client.get("/openapi.json", headers={"Accept-Encoding": "identity"})
+    assert plain.headers["etag"] != response.headers["etag"]
+    assert gzip.decompress((tmp_path / "items" / "openapi.json.gz").read_bytes()) == plain.content
+    assert client.get("/openapi/items.json").json()["tags"] == []
+
+def test_prebuilt_openapi_refuses_a_build_for_other_models(tmp_path):
+    build(items_app(int), "items", str(tmp_path))
+    #same method and path, only the parameter type changed
+    with pytest.raises(RuntimeError):
+        use_prebuilt_openapi(items_app(str), "items", "require", str(tmp_path))
+
+def test_prebuilt_openapi_refuses_a_build_for_other_settings(tmp_path):
+    build(items_app(), "items", str(tmp_path))
+    app = items_app()
+    app.description = "a new description"
+    with pytest.raises(RuntimeError):
+        use_prebuilt_openapi(app, "items", "require", str(tmp_path))
+    app = items_app()
+    app.openapi_tags = [{"name": "items", "description": "new"}]
+    with pytest.raises(RuntimeError):
+        use_prebuilt_openapi(app, "items", "require", str(tmp_path))
+
+def test_metadata_apps_import_from_their_folder():
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metadata")
+    subprocess.run([sys.executable, "-c", "import docs, main, tags, urls"], cwd=folder, check=True)
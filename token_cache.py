@@ -0,0 +1,90 @@
+#cache of verified JWTs
+#a client sends the same token with every request until it expires
+#and each time the token was decoded, its signature checked and the user looked up again
+#this keeps the user a token resolved to, until the token's exp
+#used by get_current_user_real in fastapibasic.py
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+#configure with environment variables, a size of 0 turns the cache off
+#max_ttl bounds how long a change to a user (e.g. disabled) can go unseen by tokens already cached
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_MAX_TTL = float(os.environ.get("TOKEN_CACHE_MAX_TTL", "60"))
+
+
+class VerifiedTokenCache:
+    def __init__(self, maxsize: int, max_ttl: float):
+        self.maxsize = maxsize
+        self.max_ttl = max_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    #keys are digests, so the cache never holds usable tokens and every key has the same small size
+    @staticmethod
+    def key(token: str):
+        return hashlib.sha256(token.encode()).digest()
+
+    #the user of a token verified before, or None
+    #an entry is never used at or after the token's exp, an expired token has to fail decoding again
+    def get(self, token: str):
+        key = self.key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, expires_at = entry
+            if expires_at <= now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return user
+
+    #only call this after the token was decoded and verified
+    #exp is the token's exp claim (seconds since the epoch), None for a token without one
+    #(a signed token does not need an exp, such a token is kept for max_ttl)
+    def put(self, token: str, user, exp: float | None):
+        if self.maxsize <= 0:
+            return
+        key = self.key(token)
+        expires_at = time.time() + self.max_ttl
+        if exp is not None:
+            expires_at = min(float(exp), expires_at)
+        with self._lock:
+            self._data[key] = (user, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+
+token_cache = VerifiedTokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_MAX_TTL)